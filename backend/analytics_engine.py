@@ -0,0 +1,184 @@
+"""Vectorized analytics over raw events, for date ranges the rollups don't cover.
+
+A page's events are loaded as columns: int64 epoch seconds, int8 event type
+codes and int32 categorical target codes. Histograms and group-bys are then
+numpy bincounts, O(events) for any number of buckets. ColumnArchive keeps
+the same columns for old events in compressed files on disk.
+"""
+import os
+import tempfile
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+EVENT_TYPES = ("view", "click")
+GRANULARITIES = {"hour": 3600, "day": 86400, "week": 7 * 86400}
+
+_TYPE_CODES = {name: code for code, name in enumerate(EVENT_TYPES)}
+
+
+def _epoch_second(value) -> int:
+    if isinstance(value, datetime):
+        return int((value if value.tzinfo else value.replace(tzinfo=timezone.utc)).timestamp())
+    if isinstance(value, (int, float)):
+        # Epoch milliseconds
+        return int(value // 1000)
+    return int(np.datetime64(value[:19], "s").astype(np.int64))
+
+
+def _epoch_seconds(timestamps: list) -> np.ndarray:
+    """Epoch seconds of stored times: datetimes, epoch milliseconds or legacy UTC ISO strings."""
+    if all(isinstance(ts, str) for ts in timestamps):
+        # The first 19 characters of an ISO string are the time, without offset
+        return np.array([ts[:19] for ts in timestamps], dtype="datetime64[s]").astype(np.int64)
+    if all(isinstance(ts, int) for ts in timestamps):
+        return np.array(timestamps, dtype=np.int64) // 1000
+    return np.array([_epoch_second(ts) for ts in timestamps], dtype=np.int64)
+
+
+class EventColumns:
+    """Columnar events of one page. Fill with append() batch by batch, then call finish()."""
+
+    def __init__(self):
+        self.targets: List[str] = []
+        self._target_codes: Dict[str, int] = {}
+        self._chunks: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+        self.timestamps = np.empty(0, dtype=np.int64)
+        self.types = np.empty(0, dtype=np.int8)
+        self.target_codes = np.empty(0, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def _code(self, target: Optional[str]) -> int:
+        if not target:
+            return -1
+        code = self._target_codes.get(target)
+        if code is None:
+            code = self._target_codes[target] = len(self.targets)
+            self.targets.append(target)
+        return code
+
+    def append(self, events: List[dict]):
+        """Adds a batch of event documents (timestamp, event_type, target_id)."""
+        if not events:
+            return
+        self._chunks.append((
+            _epoch_seconds([event["timestamp"] for event in events]),
+            np.array([_TYPE_CODES.get(event.get("event_type"), -1) for event in events], dtype=np.int8),
+            np.array([self._code(event.get("target_id")) for event in events], dtype=np.int32),
+        ))
+
+    def append_columns(self, timestamps: np.ndarray, types: np.ndarray, target_codes: np.ndarray, targets: List[str]):
+        """Adds ready-made columns whose target codes index targets."""
+        if not len(timestamps):
+            return
+        if targets:
+            # Translate the codes to this object's codes
+            mapping = np.array([self._code(target) for target in targets], dtype=np.int32)
+            codes = np.where(target_codes >= 0, mapping[np.maximum(target_codes, 0)], -1)
+        else:
+            codes = np.full(len(timestamps), -1)
+        self._chunks.append((timestamps.astype(np.int64), types.astype(np.int8), codes.astype(np.int32)))
+
+    def finish(self) -> "EventColumns":
+        if self._chunks:
+            timestamps, types, targets = zip(*self._chunks)
+            self.timestamps = np.concatenate((self.timestamps, *timestamps))
+            self.types = np.concatenate((self.types, *types))
+            self.target_codes = np.concatenate((self.target_codes, *targets))
+            self._chunks = []
+        return self
+
+
+def histogram(columns: EventColumns, start: int, end: int, step: int) -> Dict[str, np.ndarray]:
+    """Event counts per type in the buckets [start + i*step, start + (i+1)*step) up to end (epoch seconds)."""
+    buckets = -(-(end - start) // step)
+    in_range = (columns.timestamps >= start) & (columns.timestamps < end)
+    indexes = (columns.timestamps[in_range] - start) // step
+    types = columns.types[in_range]
+    return {
+        name: np.bincount(indexes[types == code], minlength=buckets)
+        for code, name in enumerate(EVENT_TYPES)
+    }
+
+
+def top_targets(columns: EventColumns, start: int, end: int, limit: int) -> List[Tuple[str, int]]:
+    """The most clicked targets between start and end, as (target_id, clicks)."""
+    clicks = (
+        (columns.types == _TYPE_CODES["click"]) & (columns.target_codes >= 0)
+        & (columns.timestamps >= start) & (columns.timestamps < end)
+    )
+    counts = np.bincount(columns.target_codes[clicks], minlength=len(columns.targets))
+    order = np.argsort(counts, kind="stable")[::-1][:limit]
+    return [(columns.targets[code], int(counts[code])) for code in order if counts[code]]
+
+
+class ColumnArchive:
+    """Compressed columnar archive of old events: one .npz file per page and month.
+
+    A file holds the timestamp, type and target code columns and the target
+    ids the codes refer to. Appending rewrites the month's file into a
+    temporary file that then replaces it, so readers never see a partial one.
+    Appends can be tagged with a batch id, which the file records: appending
+    the same batch again leaves the months that already hold it as they are.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def _page_directory(self, page_id: str) -> str:
+        return os.path.join(self.directory, os.path.basename(page_id))
+
+    def _read(self, path: str, columns: EventColumns) -> List[str]:
+        with np.load(path, allow_pickle=False) as data:
+            columns.append_columns(data["timestamps"], data["types"], data["target_codes"], data["targets"].tolist())
+            return data["batches"].tolist() if "batches" in data else []
+
+    def append(self, page_id: str, columns: EventColumns, batch: Optional[str] = None):
+        """Adds finished columns to the page's month files, once per batch id."""
+        if not len(columns):
+            return
+        directory = self._page_directory(page_id)
+        os.makedirs(directory, exist_ok=True)
+        months = columns.timestamps.astype("datetime64[s]").astype("datetime64[M]")
+        for month in np.unique(months):
+            path = os.path.join(directory, f"{month}.npz")
+            merged = EventColumns()
+            batches = self._read(path, merged) if os.path.exists(path) else []
+            if batch is not None:
+                if batch in batches:
+                    continue
+                batches.append(batch)
+            in_month = months == month
+            merged.append_columns(columns.timestamps[in_month], columns.types[in_month],
+                                  columns.target_codes[in_month], columns.targets)
+            merged.finish()
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    np.savez_compressed(
+                        f,
+                        timestamps=merged.timestamps,
+                        types=merged.types,
+                        target_codes=merged.target_codes,
+                        targets=np.array(merged.targets, dtype=str),
+                        batches=np.array(batches, dtype=str),
+                    )
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+
+    def load(self, columns: EventColumns, page_id: str, start: int, end: int):
+        """Adds the archived events of the months overlapping [start, end) (epoch seconds) to columns."""
+        directory = self._page_directory(page_id)
+        if not os.path.isdir(directory):
+            return
+        first = str(np.datetime64(start, "s").astype("datetime64[M]"))
+        last = str(np.datetime64(end - 1, "s").astype("datetime64[M]"))
+        for name in sorted(os.listdir(directory)):
+            month, ext = os.path.splitext(name)
+            if ext == ".npz" and first <= month <= last:
+                self._read(os.path.join(directory, name), columns)
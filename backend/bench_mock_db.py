@@ -0,0 +1,114 @@
+"""Request latency of the mock DB under concurrent writes.
+
+Runs simulated requests (an indexed find_one after a short sleep) next to
+writer tasks inserting into a large collection, and prints p50/p99/max
+request latency for each save strategy:
+
+    python bench_mock_db.py [--docs 20000] [--writers 8] [--seconds 5]
+
+"inline-pretty" is the old behaviour: every write serializes the whole
+collection with indent=2 on the event loop thread.
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+from mock_db import AsyncMockClient
+
+
+class InlineSaveClient(AsyncMockClient):
+    """Saves the collection synchronously on every write, as before."""
+
+    def _persist(self, db_name, collection, op, docs, update=None):
+        self._collection_file(db_name, collection).save()
+
+
+STRATEGIES = [
+    ("inline-pretty", InlineSaveClient, {"pretty": True}),
+    ("off-loop json", AsyncMockClient, {}),
+    ("off-loop orjson", AsyncMockClient, {"codec": "orjson"}),
+    ("off-loop msgpack", AsyncMockClient, {"codec": "msgpack"}),
+    ("group commit 0.5s orjson", AsyncMockClient, {"codec": "orjson", "flush_interval": 0.5}),
+]
+
+
+def make_doc(i):
+    return {
+        "id": f"evt-{i}",
+        "page_id": f"page-{i % 50}",
+        "event_type": "click" if i % 3 else "view",
+        "timestamp": "2026-01-01T00:00:00+00:00",
+        "country": "Россия",
+        "utm_source": "telegram",
+        "referrer": "https://example.com/some/long/referrer/path",
+    }
+
+
+async def run(client_cls, options, args):
+    directory = tempfile.mkdtemp()
+    try:
+        client = InlineSaveClient(os.path.join(directory, "db.json"))
+        seed = client["bench"]
+        await seed.events.insert_many([make_doc(i) for i in range(args.docs)])
+        await seed.events.create_index("id", unique=True)
+        client.close()
+
+        client = client_cls(os.path.join(directory, "db.json"), **options)
+        db = client["bench"]
+        await db.events.create_index("id", unique=True)
+        deadline = time.perf_counter() + args.seconds
+        latencies = []
+        counter = iter(range(args.docs, 10 ** 9))
+
+        async def writer():
+            while time.perf_counter() < deadline:
+                await db.events.insert_one(make_doc(next(counter)))
+                await asyncio.sleep(args.write_pause)
+
+        async def reader(n):
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                await asyncio.sleep(0.001)
+                await db.events.find_one({"id": f"evt-{n}"})
+                latencies.append(time.perf_counter() - start)
+
+        await asyncio.gather(*[writer() for _ in range(args.writers)],
+                             *[reader(n) for n in range(args.readers)])
+        writes = next(counter) - args.docs
+        await client.flush()
+        client.close()
+        return latencies, writes
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", type=int, default=20000, help="documents in the collection being written")
+    parser.add_argument("--writers", type=int, default=8)
+    parser.add_argument("--readers", type=int, default=32)
+    parser.add_argument("--write-pause", type=float, default=0.01, help="seconds between writes of one writer")
+    parser.add_argument("--seconds", type=float, default=5.0)
+    args = parser.parse_args()
+
+    print(f"{args.docs} docs, {args.writers} writers, {args.readers} readers, {args.seconds}s per run")
+    print(f"{'strategy':<26}{'requests':>10}{'writes':>8}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for name, client_cls, options in STRATEGIES:
+        latencies, writes = await run(client_cls, options, args)
+        print(f"{name:<26}{len(latencies):>10}{writes:>8}"
+              f"{statistics.median(latencies) * 1000:>9.1f}"
+              f"{percentile(latencies, 0.99) * 1000:>9.1f}"
+              f"{max(latencies) * 1000:>9.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,102 @@
+"""Offline IP to country lookup over a local IP-range table.
+
+The table is a CSV file (optionally gzipped) with one range per row:
+start, end, country code and an optional country name. Addresses are
+either dotted/colon notation or integers, so the usual free country
+databases (IP2Location LITE DB1, DB-IP country lite) load as they are.
+Rows that don't parse, such as a header, are skipped.
+"""
+import bisect
+import csv
+import functools
+import gzip
+import ipaddress
+import os
+from array import array
+from typing import List, Optional, Tuple
+
+GeoResult = Tuple[str, str, str]  # (country code, country name, flag emoji)
+
+
+def _address(value: str) -> int:
+    value = value.strip()
+    return int(value) if value.isdigit() else int(ipaddress.ip_address(value))
+
+
+def _flag(code: str) -> str:
+    if len(code) != 2 or not code.isalpha():
+        return ""
+    return "".join(chr(0x1F1E6 + ord(c) - ord("A")) for c in code.upper())
+
+
+class _Ranges:
+    """Sorted, non-overlapping ranges of one address family, searched with bisect."""
+
+    def __init__(self, typecode: Optional[str]):
+        # A typed array takes 4 bytes per IPv4 address; IPv6 addresses don't fit one, so they stay ints
+        self.starts = array(typecode) if typecode else []
+        self.ends = array(typecode) if typecode else []
+        self.countries = array("H")
+
+    def __len__(self):
+        return len(self.starts)
+
+    def find(self, address: int) -> Optional[int]:
+        i = bisect.bisect_right(self.starts, address) - 1
+        if i >= 0 and address <= self.ends[i]:
+            return self.countries[i]
+        return None
+
+
+class GeoIPTable:
+    """IP ranges of one table file, with an LRU cache of the last looked up addresses."""
+
+    def __init__(self, path: str, cache_size: int = 10000):
+        self.path = path
+        self.mtime = os.path.getmtime(path)
+        self._countries: List[GeoResult] = []
+        self._v4 = _Ranges("I")
+        self._v6 = _Ranges(None)
+        self._load()
+        self.lookup = functools.lru_cache(maxsize=cache_size)(self._lookup)
+
+    def __len__(self):
+        return len(self._v4) + len(self._v6)
+
+    def _load(self):
+        rows = {4: [], 6: []}
+        codes = {}
+        opener = gzip.open if self.path.endswith(".gz") else open
+        with opener(self.path, "rt", encoding="utf-8", newline="") as f:
+            for row in csv.reader(f):
+                if len(row) < 3 or row[0].startswith("#"):
+                    continue
+                try:
+                    start, end = _address(row[0]), _address(row[1])
+                except ValueError:
+                    continue
+                code = row[2].strip().upper()
+                if not code or code == "-" or code == "ZZ":
+                    continue
+                if code not in codes:
+                    name = row[3].strip() if len(row) > 3 and row[3].strip() != "-" else ""
+                    codes[code] = len(self._countries)
+                    self._countries.append((code, name or code, _flag(code)))
+                family = 4 if ":" not in row[0] and end <= 0xFFFFFFFF else 6
+                rows[family].append((start, end, codes[code]))
+        for family, ranges in ((4, self._v4), (6, self._v6)):
+            for start, end, country in sorted(rows[family]):
+                ranges.starts.append(start)
+                ranges.ends.append(end)
+                ranges.countries.append(country)
+
+    def _lookup(self, ip: str) -> Optional[GeoResult]:
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        ranges = self._v4 if address.version == 4 else self._v6
+        country = ranges.find(int(address))
+        return self._countries[country] if country is not None else None
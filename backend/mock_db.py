@@ -1,34 +1,790 @@
 import json
 import os
 import asyncio
-from typing import List, Dict, Any, Optional
+import bisect
+import contextlib
+import copy
+import functools
+import heapq
+import itertools
+import logging
+import re
+import time
+from datetime import datetime, timezone
+from typing import List, Dict, Any, Iterable, Optional
+
+try:
+    from pymongo.errors import DuplicateKeyError
+except ImportError:
+    class DuplicateKeyError(Exception):
+        pass
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# ===== File codecs =====
+
+class JsonCodec:
+    """Stdlib json. Compact by default; pretty=True keeps the indented format for debugging."""
+    name = "json"
+    ext = ".json"
+
+    def __init__(self, pretty=False):
+        self.pretty = pretty
+
+    def dumps(self, data) -> bytes:
+        if self.pretty:
+            return json.dumps(data, indent=2, ensure_ascii=False).encode('utf-8')
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode('utf-8')
+
+    def loads(self, raw: bytes):
+        return json.loads(raw)
+
+    def dumps_line(self, record) -> str:
+        return json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+
+    def loads_line(self, line: str):
+        return json.loads(line)
+
+class OrjsonCodec(JsonCodec):
+    """Same JSON files as JsonCodec, encoded and decoded by orjson."""
+    name = "orjson"
+
+    def dumps(self, data) -> bytes:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 if self.pretty else 0)
+
+    def loads(self, raw: bytes):
+        return orjson.loads(raw)
+
+    def dumps_line(self, record) -> str:
+        return orjson.dumps(record).decode('utf-8')
+
+    def loads_line(self, line: str):
+        return orjson.loads(line)
+
+class MsgpackCodec(JsonCodec):
+    """Binary msgpack collection files. Journals stay JSON lines."""
+    name = "msgpack"
+    ext = ".msgpack"
+
+    def dumps(self, data) -> bytes:
+        return msgpack.packb(data, use_bin_type=True)
+
+    def loads(self, raw: bytes):
+        return msgpack.unpackb(raw, raw=False)
+
+_CODECS = {"json": JsonCodec, "orjson": OrjsonCodec, "msgpack": MsgpackCodec}
+_CODEC_MODULES = {"orjson": lambda: orjson, "msgpack": lambda: msgpack}
+
+def get_codec(name="json", pretty=False) -> JsonCodec:
+    """Codec by name. A codec whose library is not installed falls back to stdlib json."""
+    name = (name or "json").lower()
+    if name not in _CODECS:
+        raise ValueError(f"Unknown mock DB codec: {name}")
+    if name in _CODEC_MODULES and _CODEC_MODULES[name]() is None:
+        logging.warning(f"Mock DB codec {name} is not installed, using json")
+        name = "json"
+    return _CODECS[name](pretty=pretty)
 
 class MockUpdateResult:
-    def __init__(self, matched_count, modified_count):
+    def __init__(self, matched_count, modified_count, upserted_id=None):
         self.matched_count = matched_count
         self.modified_count = modified_count
-        self.upserted_id = None
+        self.upserted_id = upserted_id
+
+_MISSING = object()
+
+# Top-level key holding the journal generation in the legacy single-file format
+JOURNAL_META_KEY = "$journal"
+
+def _index_key(value):
+    # Hashable form of a field value, equal values map to equal keys
+    if isinstance(value, dict):
+        return ("$dict", tuple(sorted(((k, _index_key(v)) for k, v in value.items()), key=lambda kv: kv[0])))
+    if isinstance(value, list):
+        return ("$list", tuple(_index_key(v) for v in value))
+    return value
+
+# BSON-like ordering across types so mixed or missing values still sort
+_SORT_TYPE_ORDER = {type(None): 1, int: 2, float: 2, str: 3, dict: 4, list: 5, bool: 8, datetime: 9}
+
+def _sort_value(value):
+    rank = _SORT_TYPE_ORDER.get(type(value), 10)
+    if rank in (4, 5, 10):
+        return (rank, json.dumps(value, sort_keys=True, default=str))
+    return (rank, value)
+
+def _bson_type(value) -> str:
+    """Name of the BSON type of value, as $type reports it."""
+    if value is _MISSING:
+        return "missing"
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, int):
+        return "int" if -2 ** 31 <= value < 2 ** 31 else "long"
+    if isinstance(value, float):
+        return "double"
+    if isinstance(value, datetime):
+        return "date"
+    return {str: "string", dict: "object", list: "array"}.get(type(value), "unknown")
+
+_NUMBER_TYPES = {"int", "long", "double"}
+
+def _to_datetime(value) -> Optional[datetime]:
+    # Like $toDate: numbers are epoch milliseconds, strings ISO dates (UTC unless they have an offset)
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        moment = value
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        return datetime.fromtimestamp(value / 1000, tz=timezone.utc)
+    else:
+        moment = datetime.fromisoformat(str(value))
+    return moment.astimezone(timezone.utc) if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+def _get_path(doc, path, default=None):
+    """Reads a possibly dotted field ("metadata.country", "items.0.id")."""
+    if "." not in path:
+        return doc.get(path, default)
+    value = doc
+    for part in path.split("."):
+        if isinstance(value, dict) and part in value:
+            value = value[part]
+        elif isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        else:
+            return default
+    return value
+
+def _set_path(doc, path, value):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        child = doc.get(part)
+        # Copy-on-write so snapshots taken for background flushes stay consistent
+        child = dict(child) if isinstance(child, dict) else {}
+        doc[part] = child
+        doc = child
+    doc[parts[-1]] = value
+
+def _unset_path(doc, path) -> bool:
+    parts = path.split(".")
+    for part in parts[:-1]:
+        child = doc.get(part)
+        if not isinstance(child, dict):
+            return False
+        child = dict(child)
+        doc[part] = child
+        doc = child
+    return doc.pop(parts[-1], _MISSING) is not _MISSING
+
+_REGEX_FLAGS = {"i": re.IGNORECASE, "m": re.MULTILINE, "s": re.DOTALL, "x": re.VERBOSE}
+_RANGE_OPERATORS = {"$gt", "$gte", "$lt", "$lte"}
+
+def _is_operator_dict(cond) -> bool:
+    return isinstance(cond, dict) and bool(cond) and all(k.startswith("$") for k in cond)
+
+def _compare(value, operator, bound) -> bool:
+    # Like Mongo, ranges only match values of the same type bracket
+    if value is _MISSING:
+        return False
+    left, right = _sort_value(value), _sort_value(bound)
+    if left[0] != right[0]:
+        return False
+    if operator == "$gt":
+        return left > right
+    if operator == "$gte":
+        return left >= right
+    if operator == "$lt":
+        return left < right
+    return left <= right
+
+def _matches_condition(value, cond) -> bool:
+    present = None if value is _MISSING else value
+    if not _is_operator_dict(cond):
+        return present == cond
+
+    for operator, operand in cond.items():
+        if operator in _RANGE_OPERATORS:
+            if not _compare(value, operator, operand):
+                return False
+        elif operator == "$in":
+            if present not in operand:
+                return False
+        elif operator == "$nin":
+            if present in operand:
+                return False
+        elif operator == "$ne":
+            if present == operand:
+                return False
+        elif operator == "$exists":
+            if (value is not _MISSING) != bool(operand):
+                return False
+        elif operator == "$type":
+            wanted = set(operand) if isinstance(operand, list) else {operand}
+            if "number" in wanted:
+                wanted |= _NUMBER_TYPES
+            if value is _MISSING or _bson_type(value) not in wanted:
+                return False
+        elif operator == "$regex":
+            if not isinstance(value, str):
+                return False
+            pattern = operand
+            if not isinstance(pattern, re.Pattern):
+                flags = 0
+                for flag in cond.get("$options", ""):
+                    flags |= _REGEX_FLAGS.get(flag, 0)
+                pattern = re.compile(pattern, flags)
+            if not pattern.search(value):
+                return False
+        elif operator != "$options":
+            raise NotImplementedError(f"Mock DB does not support query operator {operator}")
+    return True
+
+def _matches(doc, filter_query) -> bool:
+    for k, v in filter_query.items():
+        if k == "_id": # ignore implementation detail _id
+            continue
+        if k == "$and":
+            if not all(_matches(doc, sub) for sub in v):
+                return False
+        elif k == "$or":
+            if not any(_matches(doc, sub) for sub in v):
+                return False
+        elif not _matches_condition(_get_path(doc, k, _MISSING), v):
+            return False
+    return True
+
+def _apply_update(doc, update, track_changes=True):
+    modified = False
+    # Apply $set
+    if "$set" in update:
+        for k, v in update["$set"].items():
+            if not track_changes or _get_path(doc, k, _MISSING) != v:
+                _set_path(doc, k, v)
+                modified = True
+
+    # Apply $unset
+    if "$unset" in update:
+        for k in update["$unset"]:
+            if _unset_path(doc, k):
+                modified = True
+
+    # Apply $inc
+    if "$inc" in update:
+        for k, amount in update["$inc"].items():
+            current = _get_path(doc, k, _MISSING)
+            if amount or current is _MISSING:
+                _set_path(doc, k, (0 if current is _MISSING else current) + amount)
+                modified = True
+
+    # Apply $push and $addToSet, both accept {"$each": [...]}
+    for operator in ("$push", "$addToSet"):
+        for k, v in update.get(operator, {}).items():
+            items = v["$each"] if isinstance(v, dict) and "$each" in v else [v]
+            current = _get_path(doc, k, _MISSING)
+            if current is _MISSING:
+                current = []
+            if not isinstance(current, list):
+                continue
+            if operator == "$addToSet":
+                added = []
+                for item in items:
+                    if item not in current and item not in added:
+                        added.append(item)
+                items = added
+            if items:
+                # Copy-on-write so snapshots taken for background flushes stay consistent
+                _set_path(doc, k, current + items)
+                modified = True
+
+    # Apply $pull
+    if "$pull" in update:
+        for k, v in update["$pull"].items():
+            current = _get_path(doc, k)
+            if isinstance(current, list):
+                if _is_operator_dict(v):
+                    kept = [item for item in current if not _matches_condition(item, v)]
+                elif isinstance(v, dict):
+                    # match items that contain all key-values from v
+                    kept = [item for item in current if not (isinstance(item, dict) and _matches(item, v))]
+                else:
+                    kept = [item for item in current if item != v]
+                if len(kept) != len(current):
+                    _set_path(doc, k, kept)
+                    modified = True
+    return modified
+
+def _upsert_document(filter_query, update):
+    """The document an upsert inserts: the filter's equality fields, then the update including $setOnInsert."""
+    doc = {}
+    for key, cond in filter_query.items():
+        if not key.startswith("$") and not _is_operator_dict(cond):
+            _set_path(doc, key, cond)
+    _apply_update(doc, update, track_changes=False)
+    if "$setOnInsert" in update:
+        _apply_update(doc, {"$set": update["$setOnInsert"]}, track_changes=False)
+    return doc
+
+class MockIndex:
+    """Secondary hash index: field value -> documents holding it (by identity).
+
+    A sorted list of the distinct keys is kept alongside, built on the first
+    range query, so $gt/$gte/$lt/$lte on an indexed field can be answered
+    with a bisect instead of a scan.
+    """
+
+    def __init__(self, field: str, unique: bool = False):
+        self.field = field
+        self.unique = unique
+        self.entries: Dict[Any, Dict[int, Dict[str, Any]]] = {}
+        self._sorted_keys: Optional[List[Any]] = None
+        self._sorted_values: Optional[List[tuple]] = None
+
+    def key_of(self, doc):
+        return _index_key(_get_path(doc, self.field))
+
+    def check(self, doc, key=None, new=False):
+        """Raises DuplicateKeyError if adding doc would break uniqueness.
+
+        An updated doc may already hold its own key; a new one, even the
+        same dict inserted a second time, may not.
+        """
+        if not self.unique:
+            return
+        if key is None:
+            key = self.key_of(doc)
+        bucket = self.entries.get(key)
+        if bucket and (new or any(other is not doc for other in bucket.values())):
+            raise DuplicateKeyError(
+                f"E11000 duplicate key error index: {self.field}_1 dup key: {{ {self.field}: {_get_path(doc, self.field)!r} }}"
+            )
+
+    def add(self, doc):
+        key = self.key_of(doc)
+        bucket = self.entries.get(key)
+        if bucket is None:
+            bucket = self.entries[key] = {}
+            self._add_sorted_key(key)
+        bucket[id(doc)] = doc
+
+    def remove(self, doc, key=None):
+        if key is None:
+            key = self.key_of(doc)
+        bucket = self.entries.get(key)
+        if bucket is not None:
+            bucket.pop(id(doc), None)
+            if not bucket:
+                del self.entries[key]
+                self._remove_sorted_key(key)
+
+    def lookup(self, value) -> List[Dict[str, Any]]:
+        bucket = self.entries.get(_index_key(value))
+        return list(bucket.values()) if bucket else []
+
+    def range(self, cond) -> List[Dict[str, Any]]:
+        """Documents whose key satisfies the $gt/$gte/$lt/$lte bounds in cond."""
+        if self._sorted_values is None:
+            self._sorted_keys = sorted(self.entries, key=_sort_value)
+            self._sorted_values = [_sort_value(key) for key in self._sorted_keys]
+        values = self._sorted_values
+        lo, hi = 0, len(values)
+        for operator, bound in cond.items():
+            bound_value = _sort_value(bound)
+            # Stay inside the bound's type bracket
+            lo = max(lo, bisect.bisect_left(values, (bound_value[0],)))
+            hi = min(hi, bisect.bisect_left(values, (bound_value[0] + 1,)))
+            if operator == "$gt":
+                lo = max(lo, bisect.bisect_right(values, bound_value))
+            elif operator == "$gte":
+                lo = max(lo, bisect.bisect_left(values, bound_value))
+            elif operator == "$lt":
+                hi = min(hi, bisect.bisect_left(values, bound_value))
+            elif operator == "$lte":
+                hi = min(hi, bisect.bisect_right(values, bound_value))
+        found = []
+        for key in self._sorted_keys[lo:hi]:
+            found.extend(self.entries[key].values())
+        return found
+
+    def _add_sorted_key(self, key):
+        if self._sorted_values is None:
+            return
+        value = _sort_value(key)
+        # Common case for timestamps: the new key sorts last
+        if not self._sorted_values or value >= self._sorted_values[-1]:
+            self._sorted_keys.append(key)
+            self._sorted_values.append(value)
+        else:
+            position = bisect.bisect_right(self._sorted_values, value)
+            self._sorted_keys.insert(position, key)
+            self._sorted_values.insert(position, value)
+
+    def _remove_sorted_key(self, key):
+        if self._sorted_values is None:
+            return
+        position = bisect.bisect_left(self._sorted_values, _sort_value(key))
+        while position < len(self._sorted_keys) and self._sorted_keys[position] != key:
+            position += 1
+        if position < len(self._sorted_keys):
+            del self._sorted_keys[position]
+            del self._sorted_values[position]
+
+    def rebuild(self, data: List[Dict[str, Any]]):
+        self.entries = {}
+        self._sorted_keys = None
+        self._sorted_values = None
+        for doc in data:
+            self.check(doc)
+            self.add(doc)
+
+class _Descending:
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+def _normalize_sort(key_or_list, direction=None):
+    if isinstance(key_or_list, str):
+        return [(key_or_list, direction or 1)]
+    return [(key, direction) for key, direction in key_or_list]
+
+def _sort_key(spec):
+    def key(doc):
+        return tuple(
+            _sort_value(_get_path(doc, field)) if direction != -1 else _Descending(_sort_value(_get_path(doc, field)))
+            for field, direction in spec
+        )
+    return key
 
 class AsyncMockCursor:
-    def __init__(self, data: List[Dict[str, Any]]):
-        self._data = data
+    """Lazy cursor: nothing is matched, sorted or copied until to_list() or async iteration.
+
+    With a limit, sorting keeps only the top skip+limit documents in a heap
+    instead of sorting every match.
+    """
+
+    def __init__(self, docs: Iterable[Dict[str, Any]], project=None, prepare=None):
+        self._source = docs
+        self._project = project
+        # Coroutine function run once before the first document is produced
+        self._prepare = prepare
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+        self._iterator = None
 
     def sort(self, key_or_list, direction=None):
-        if isinstance(key_or_list, str):
-            key = key_or_list
-            reverse = direction == -1
-        else:
-            # simple support for list of tuples [('order', 1)]
-            key = key_or_list[0][0]
-            reverse = key_or_list[0][1] == -1
-            
-        self._data.sort(key=lambda x: x.get(key, 0), reverse=reverse)
+        self._sort = _normalize_sort(key_or_list, direction)
+        return self
+
+    def skip(self, count: int):
+        self._skip = count
+        return self
+
+    def limit(self, count: int):
+        self._limit = count
+        return self
+
+    def batch_size(self, count: int):
+        # Motor compatibility: documents are produced one at a time anyway
+        return self
+
+    def _iterate(self, length: Optional[int] = None):
+        limit = self._limit or None
+        if length is not None:
+            limit = min(limit, length) if limit else length
+        docs = self._source
+        if self._sort:
+            key = _sort_key(self._sort)
+            if limit is not None:
+                docs = heapq.nsmallest(self._skip + limit, docs, key=key)
+            else:
+                docs = sorted(docs, key=key)
+        stop = self._skip + limit if limit is not None else None
+        docs = itertools.islice(docs, self._skip, stop)
+        if self._project is not None:
+            docs = map(self._project, docs)
+        return docs
+
+    async def _prepared(self):
+        if self._prepare is not None:
+            prepare, self._prepare = self._prepare, None
+            await prepare()
+
+    async def to_list(self, length: Optional[int] = None):
+        await self._prepared()
+        return list(self._iterate(length))
+
+    def __aiter__(self):
         return self
 
-    async def to_list(self, length: int):
-        if length is None:
-            return self._data
-        return self._data[:length]
+    async def __anext__(self):
+        if self._iterator is None:
+            await self._prepared()
+            self._iterator = self._iterate()
+        try:
+            return next(self._iterator)
+        except StopIteration:
+            raise StopAsyncIteration
+
+# ===== Aggregation =====
+
+def _expr_compare(operator, left, right) -> bool:
+    left, right = _sort_value(left), _sort_value(right)
+    if operator == "$eq":
+        return left == right
+    if operator == "$ne":
+        return left != right
+    if operator == "$gt":
+        return left > right
+    if operator == "$gte":
+        return left >= right
+    if operator == "$lt":
+        return left < right
+    return left <= right
+
+def _evaluate(expr, doc):
+    """Evaluates an aggregation expression ("$field", {"$op": args}, literals) against doc."""
+    if isinstance(expr, str):
+        if expr == "$$ROOT":
+            return doc
+        if expr.startswith("$"):
+            return _get_path(doc, expr[1:])
+        return expr
+    if isinstance(expr, list):
+        return [_evaluate(item, doc) for item in expr]
+    if not isinstance(expr, dict):
+        return expr
+    if not _is_operator_dict(expr):
+        return {k: _evaluate(v, doc) for k, v in expr.items()}
+
+    operator, args = next(iter(expr.items()))
+    if operator == "$literal":
+        return args
+    if operator == "$cond":
+        if isinstance(args, dict):
+            args = [args["if"], args["then"], args["else"]]
+        return _evaluate(args[1] if _evaluate(args[0], doc) else args[2], doc)
+
+    values = [_evaluate(arg, doc) for arg in args] if isinstance(args, list) else [_evaluate(args, doc)]
+    if operator == "$ifNull":
+        return next((v for v in values if v is not None), None)
+    if operator in ("$eq", "$ne", "$gt", "$gte", "$lt", "$lte"):
+        return _expr_compare(operator, values[0], values[1])
+    if operator == "$and":
+        return all(values)
+    if operator == "$or":
+        return any(values)
+    if operator == "$not":
+        return not values[0]
+    if operator == "$in":
+        return values[0] in (values[1] or [])
+    if operator == "$add":
+        return sum(v for v in values if v is not None)
+    if operator == "$subtract":
+        return values[0] - values[1]
+    if operator == "$multiply":
+        result = 1
+        for v in values:
+            result *= v
+        return result
+    if operator == "$divide":
+        return values[0] / values[1]
+    if operator in ("$substr", "$substrCP", "$substrBytes"):
+        text = "" if values[0] is None else str(values[0])
+        start, length = values[1], values[2]
+        return text[start:] if length < 0 else text[start:start + length]
+    if operator == "$concat":
+        if any(v is None for v in values):
+            return None
+        return "".join(values)
+    if operator == "$toLower":
+        return (values[0] or "").lower()
+    if operator == "$toUpper":
+        return (values[0] or "").upper()
+    if operator == "$size":
+        return len(values[0])
+    if operator == "$arrayElemAt":
+        items, position = values
+        return items[position] if -len(items) <= position < len(items) else None
+    if operator == "$type":
+        # A missing field is "missing", not "null"
+        if isinstance(args, str) and args.startswith("$"):
+            return _bson_type(_get_path(doc, args[1:], _MISSING))
+        return _bson_type(values[0])
+    if operator == "$toDate":
+        return _to_datetime(values[0])
+    if operator == "$dateToString":
+        moment = _to_datetime(values[0].get("date"))
+        if moment is None:
+            return None
+        date_format = values[0].get("format", "%Y-%m-%dT%H:%M:%S.%LZ")
+        return moment.strftime(date_format.replace("%L", f"{moment.microsecond // 1000:03d}"))
+    raise NotImplementedError(f"Mock DB does not support expression operator {operator}")
+
+_ACCUMULATORS = {"$sum", "$count", "$avg", "$min", "$max", "$first", "$last", "$push", "$addToSet"}
+
+def _group(docs, spec):
+    groups: Dict[Any, Dict[str, Any]] = {}
+    states: Dict[Any, Dict[str, Any]] = {}
+    fields = {name: acc for name, acc in spec.items() if name != "_id"}
+    for doc in docs:
+        group_id = _evaluate(spec["_id"], doc)
+        key = _index_key(group_id)
+        if key not in groups:
+            groups[key] = {"_id": group_id}
+            states[key] = {}
+        state = states[key]
+        for name, acc in fields.items():
+            operator, arg = next(iter(acc.items()))
+            if operator not in _ACCUMULATORS:
+                raise NotImplementedError(f"Mock DB does not support accumulator {operator}")
+            value = 1 if operator == "$count" else _evaluate(arg, doc)
+            if operator in ("$sum", "$count"):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    state[name] = state.get(name, 0) + value
+                else:
+                    state.setdefault(name, 0)
+            elif operator == "$avg":
+                total, count = state.get(name, (0, 0))
+                if isinstance(value, (int, float)):
+                    total, count = total + value, count + 1
+                state[name] = (total, count)
+            elif operator in ("$min", "$max"):
+                if value is None:
+                    state.setdefault(name, None)
+                    continue
+                current = state.get(name)
+                if current is None or (_sort_value(value) < _sort_value(current)) == (operator == "$min"):
+                    state[name] = value
+            elif operator == "$first":
+                state.setdefault(name, value)
+            elif operator == "$last":
+                state[name] = value
+            elif operator == "$push":
+                state.setdefault(name, []).append(value)
+            elif operator == "$addToSet":
+                items = state.setdefault(name, [])
+                if value not in items:
+                    items.append(value)
+
+    for key, result in groups.items():
+        state = states[key]
+        for name, acc in fields.items():
+            operator = next(iter(acc))
+            value = state.get(name)
+            if operator == "$avg":
+                value = value[0] / value[1] if value and value[1] else None
+            elif value is None and operator in ("$sum", "$count"):
+                value = 0
+            elif value is None and operator in ("$push", "$addToSet"):
+                value = []
+            result[name] = value
+        yield result
+
+def _project(doc, spec):
+    include_id = spec.get("_id", 1) not in (0, False)
+    fields = {k: v for k, v in spec.items() if k != "_id"}
+    if not fields or all(v in (0, False) for v in fields.values()):
+        # Exclusion mode
+        new_doc = dict(doc)
+        for k in fields:
+            _unset_path(new_doc, k)
+        if not include_id:
+            new_doc.pop("_id", None)
+        return new_doc
+
+    new_doc = {}
+    if include_id and "_id" in doc:
+        new_doc["_id"] = doc["_id"]
+    elif spec.get("_id") not in (None, 0, 1, False, True):
+        new_doc["_id"] = _evaluate(spec["_id"], doc)
+    for k, v in fields.items():
+        if v in (1, True):
+            value = _get_path(doc, k, _MISSING)
+            if value is not _MISSING:
+                _set_path(new_doc, k, value)
+        else:
+            _set_path(new_doc, k, _evaluate(v, doc))
+    return new_doc
+
+def _unwind(docs, spec):
+    if isinstance(spec, str):
+        spec = {"path": spec}
+    path = spec["path"][1:]
+    keep_empty = spec.get("preserveNullAndEmptyArrays", False)
+    for doc in docs:
+        value = _get_path(doc, path, _MISSING)
+        if isinstance(value, list) and value:
+            for item in value:
+                new_doc = dict(doc)
+                _set_path(new_doc, path, item)
+                yield new_doc
+        elif isinstance(value, list) or value is None or value is _MISSING:
+            if keep_empty:
+                yield dict(doc)
+        else:
+            yield doc
+
+def _lookup_collections(pipeline) -> set:
+    """Names of the collections the $lookup stages of pipeline (and of its sub-pipelines) read."""
+    names = set()
+    for stage in pipeline:
+        for operator, spec in stage.items():
+            if operator == "$lookup":
+                names.add(spec["from"])
+                names |= _lookup_collections(spec.get("pipeline", []))
+            elif operator == "$facet":
+                for sub_pipeline in spec.values():
+                    names |= _lookup_collections(sub_pipeline)
+    return names
+
+def _exclusive(method):
+    """Multi-process mode: runs a write under the collection lock on fresh data and saves it before unlocking."""
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        await self._ensure_loaded()
+        client = self.db.client
+        if not client.shared:
+            return await method(self, *args, **kwargs)
+        collection_file = client._collection_file(self.db.name, self.name)
+        await collection_file.acquire()
+        try:
+            self._reload_if_changed(collection_file)
+            return await method(self, *args, **kwargs)
+        finally:
+            try:
+                if collection_file.dirty:
+                    snapshot = collection_file.snapshot(copy=True)
+                    collection_file.dirty = False
+                    try:
+                        await asyncio.to_thread(collection_file.write, snapshot)
+                    except Exception:
+                        collection_file.dirty = True
+                        raise
+            finally:
+                collection_file.release()
+    return wrapper
 
 class AsyncMockCollection:
     def __init__(self, db, name):
@@ -38,26 +794,125 @@ class AsyncMockCollection:
     def _get_collection_data(self) -> List[Dict[str, Any]]:
         return self.db.data.get(self.name, [])
 
-    def _save_collection_data(self, data: List[Dict[str, Any]]):
+    def _save_collection_data(self, data: List[Dict[str, Any]], op=None, docs=None, update=None):
         self.db.data[self.name] = data
-        self.db._save()
+        self.db._persist(self.name, op, docs, update)
+
+    def _get_indexes(self) -> Dict[str, MockIndex]:
+        return self.db.indexes.get(self.name, {})
+
+    def _refresh(self):
+        """Multi-process mode: picks up what other processes wrote to the collection file."""
+        if not self.db.client.shared:
+            return
+        collection_file = self.db.client._collection_file(self.db.name, self.name)
+        # Not read yet (the first use reads it), or a write of this process is in flight: memory is ahead of the file
+        if not collection_file.loaded or (collection_file.lock is not None and collection_file.lock.locked()):
+            return
+        self._reload_if_changed(collection_file)
+
+    def _reload_if_changed(self, collection_file):
+        if collection_file.changed_on_disk():
+            collection_file.load()
+            for index in self._get_indexes().values():
+                index.rebuild(self._get_collection_data())
+
+    async def _ensure_loaded(self):
+        """Reads the collection file in a worker thread on first use and builds the indexes recorded so far."""
+        collection_file = self.db.client._collection_file(self.db.name, self.name)
+        if collection_file.loaded:
+            return
+        if collection_file.load_lock is None:
+            collection_file.load_lock = asyncio.Lock()
+        async with collection_file.load_lock:
+            if collection_file.loaded:
+                return
+            await asyncio.to_thread(collection_file.load)
+            indexes = self._get_indexes()
+            for field, index in list(indexes.items()):
+                try:
+                    index.rebuild(self._get_collection_data())
+                except DuplicateKeyError as e:
+                    logging.warning(f"Mock DB index {self.name}.{field} dropped: {e}")
+                    del indexes[field]
+
+    async def _prepare(self):
+        await self._ensure_loaded()
+        self._refresh()
+
+    def _index_insert(self, doc):
+        indexes = self._get_indexes().values()
+        for index in indexes:
+            index.check(doc, new=True)
+        for index in indexes:
+            index.add(doc)
+
+    def _index_remove(self, doc):
+        for index in self._get_indexes().values():
+            index.remove(doc)
+
+    def _candidates(self, filter_query) -> List[Dict[str, Any]]:
+        """Picks the smallest index bucket usable for filter_query, or falls back to a full scan.
+
+        Equality and $in filters on indexed fields are answered from the hash
+        indexes, range filters from their sorted keys; every candidate is still
+        checked with _matches by the caller.
+        """
+        indexes = self._get_indexes()
+        best = None
+        for field, cond in filter_query.items():
+            index = indexes.get(field)
+            if index is None:
+                continue
+            if _is_operator_dict(cond):
+                if set(cond) == {"$in"}:
+                    seen = {}
+                    for value in cond["$in"]:
+                        for doc in index.lookup(value):
+                            seen[id(doc)] = doc
+                    found = list(seen.values())
+                elif set(cond) <= _RANGE_OPERATORS:
+                    found = index.range(cond)
+                else:
+                    continue
+            else:
+                found = index.lookup(cond)
+            if best is None or len(found) < len(best):
+                best = found
+                if not best:
+                    break
+        if best is None:
+            return self._get_collection_data()
+        return best
+
+    async def create_index(self, keys, unique=False, **kwargs):
+        # Compound indexes are served by their leading field
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        field = keys[0][0]
+        name = kwargs.get("name") or "_".join(f"{k}_{d}" for k, d in keys)
+        if unique and len(keys) > 1:
+            raise NotImplementedError("Mock DB supports unique indexes on a single field only")
+        self._refresh()
+
+        collection_indexes = self.db.indexes.setdefault(self.name, {})
+        existing = collection_indexes.get(field)
+        if existing is not None and (existing.unique or not unique):
+            return name
+        index = MockIndex(field, unique=unique)
+        # An unread collection only records the index; it is built when the data is loaded
+        if self.db.client._collection_file(self.db.name, self.name).loaded:
+            index.rebuild(self._get_collection_data())
+        collection_indexes[field] = index
+        return name
 
     def _matches(self, doc, filter_query):
-        for k, v in filter_query.items():
-            if k == "_id": # ignore implementation detail _id
-                 continue 
-            
-            val = doc.get(k)
-            if isinstance(v, dict) and "$in" in v:
-                if val not in v["$in"]:
-                    return False
-            elif val != v:
-                return False
-        return True
+        return _matches(doc, filter_query)
 
     def _apply_projection(self, doc, projection):
+        # Always a copy, like documents coming from Mongo: callers must not edit the store
         if not projection:
-            return doc
+            return dict(doc)
         
         # Simple projection handling
         is_inclusion = any(v == 1 for k, v in projection.items() if k != "_id")
@@ -81,168 +936,775 @@ class AsyncMockCollection:
                         pass
             return new_doc
 
+    def _update_indexed(self, doc, update, track_changes=True):
+        """Applies update to doc and keeps the indexes in sync; on a unique conflict doc is left untouched."""
+        indexes = self._get_indexes()
+        if not indexes:
+            return _apply_update(doc, update, track_changes)
+
+        # The update goes to a copy first, so a conflict can't leave half of it in memory
+        updated = copy.deepcopy(doc)
+        modified = _apply_update(updated, update, track_changes)
+        old_keys = {field: index.key_of(doc) for field, index in indexes.items()}
+        changed = [field for field, index in indexes.items() if index.key_of(updated) != old_keys[field]]
+        for field in changed:
+            indexes[field].check(updated)
+
+        # Swapped in place: the indexes and the collection list hold this very dict
+        doc.clear()
+        doc.update(updated)
+        for field in changed:
+            indexes[field].remove(doc, old_keys[field])
+            indexes[field].add(doc)
+        return modified
+
     async def find_one(self, filter_query, projection=None):
-        data = self._get_collection_data()
-        for doc in data:
+        await self._prepare()
+        for doc in self._candidates(filter_query):
             if self._matches(doc, filter_query):
                 return self._apply_projection(doc, projection)
         return None
 
-    def find(self, filter_query, projection=None):
-        data = self._get_collection_data()
-        filtered = []
-        for doc in data:
+    def _iter_matches(self, filter_query):
+        for doc in self._candidates(filter_query):
             if self._matches(doc, filter_query):
-                filtered.append(self._apply_projection(doc, projection))
-        return AsyncMockCursor(filtered)
+                yield doc
 
+    def find(self, filter_query=None, projection=None):
+        filter_query = filter_query or {}
+        return AsyncMockCursor(
+            self._iter_matches(filter_query),
+            lambda doc: self._apply_projection(doc, projection),
+            self._prepare,
+        )
+
+    def aggregate(self, pipeline, **kwargs):
+        """Runs a pipeline subset ($match, $group, $sort, $skip, $limit, $project,
+        $addFields/$set, $unwind, $count, $facet, $lookup), lazily like find()."""
+        pipeline = list(pipeline)
+
+        async def prepare():
+            await self._prepare()
+            for name in _lookup_collections(pipeline):
+                await self.db[name]._prepare()
+
+        def run():
+            # A leading $match can use the indexes
+            if pipeline and "$match" in pipeline[0]:
+                docs = self._iter_matches(pipeline[0]["$match"])
+                stages = pipeline[1:]
+            else:
+                docs = iter(self._get_collection_data())
+                stages = pipeline
+            yield from self._run_pipeline(docs, stages)
+
+        return AsyncMockCursor(run(), prepare=prepare)
+
+    def _run_pipeline(self, docs, pipeline):
+        # Stored documents are only read; stages that change a document work on a copy.
+        # Stages are chained lazily, so each lambda binds its own spec.
+        owned = False
+        for position, stage in enumerate(pipeline):
+            operator, spec = next(iter(stage.items()))
+            if operator == "$match":
+                docs = filter(lambda doc, spec=spec: _matches(doc, spec), docs)
+            elif operator == "$group":
+                docs = _group(docs, spec)
+                owned = True
+            elif operator == "$sort":
+                key = _sort_key(_normalize_sort(list(spec.items())))
+                following = pipeline[position + 1] if position + 1 < len(pipeline) else {}
+                if "$limit" in following:
+                    # $sort + $limit keeps only the top documents
+                    docs = iter(heapq.nsmallest(following["$limit"], docs, key=key))
+                else:
+                    docs = iter(sorted(docs, key=key))
+            elif operator == "$skip":
+                docs = itertools.islice(docs, spec, None)
+            elif operator == "$limit":
+                docs = itertools.islice(docs, spec)
+            elif operator == "$project":
+                docs = map(lambda doc, spec=spec: _project(doc, spec), docs)
+                owned = True
+            elif operator in ("$addFields", "$set"):
+                docs = map(lambda doc, spec=spec: self._add_fields(doc, spec), docs)
+                owned = True
+            elif operator == "$unwind":
+                docs = _unwind(docs, spec)
+            elif operator == "$count":
+                total = sum(1 for _ in docs)
+                docs = iter([{spec: total}] if total else [])
+                owned = True
+            elif operator == "$facet":
+                materialized = list(docs)
+                docs = iter([{
+                    name: list(self._run_pipeline(iter(materialized), sub_pipeline))
+                    for name, sub_pipeline in spec.items()
+                }])
+                owned = True
+            elif operator == "$lookup":
+                docs = map(lambda doc, spec=spec: self._lookup(doc, spec), docs)
+                owned = True
+            else:
+                raise NotImplementedError(f"Mock DB does not support pipeline stage {operator}")
+        return docs if owned else map(dict, docs)
+
+    @staticmethod
+    def _add_fields(doc, spec):
+        new_doc = dict(doc)
+        for k, v in spec.items():
+            _set_path(new_doc, k, _evaluate(v, doc))
+        return new_doc
+
+    def _lookup(self, doc, spec):
+        foreign = self.db[spec["from"]]
+        foreign._refresh()
+        if "localField" in spec:
+            local_value = _get_path(doc, spec["localField"])
+            cond = {"$in": local_value} if isinstance(local_value, list) else local_value
+            matches = foreign._iter_matches({spec["foreignField"]: cond})
+        else:
+            matches = iter(foreign._get_collection_data())
+        new_doc = dict(doc)
+        _set_path(new_doc, spec["as"], list(foreign._run_pipeline(matches, spec.get("pipeline", []))))
+        return new_doc
+
+    @_exclusive
     async def insert_one(self, document):
         data = self._get_collection_data()
+        self._index_insert(document)
         data.append(document)
-        self._save_collection_data(data)
+        self._save_collection_data(data, "i", [document])
         return True
 
-    async def insert_many(self, documents):
+    @_exclusive
+    async def insert_many(self, documents, ordered=True):
+        # Like Mongo: ordered stops at the first duplicate, unordered inserts the rest and raises at the end
         data = self._get_collection_data()
-        data.extend(documents)
-        self._save_collection_data(data)
+        inserted = []
+        duplicate = None
+        try:
+            for document in documents:
+                try:
+                    self._index_insert(document)
+                except DuplicateKeyError as e:
+                    if ordered:
+                        raise
+                    duplicate = e
+                    continue
+                data.append(document)
+                inserted.append(document)
+        finally:
+            self._save_collection_data(data, "i", inserted)
+        if duplicate is not None:
+            raise duplicate
         return True
 
     async def count_documents(self, filter_query):
-        data = self._get_collection_data()
+        await self._prepare()
         count = 0
-        for doc in data:
+        for doc in self._candidates(filter_query):
             if self._matches(doc, filter_query):
                 count += 1
         return count
 
-    async def update_one(self, filter_query, update):
+    @_exclusive
+    async def update_one(self, filter_query, update, upsert=False):
         data = self._get_collection_data()
-        for doc in data:
+        for doc in self._candidates(filter_query):
             if self._matches(doc, filter_query):
-                modified = False
-                # Apply $set
-                if "$set" in update:
-                    for k, v in update["$set"].items():
-                        if doc.get(k) != v:
-                            doc[k] = v
-                            modified = True
-                
-                # Apply $push
-                if "$push" in update:
-                    for k, v in update["$push"].items():
-                        if k not in doc:
-                            doc[k] = []
-                        if isinstance(doc[k], list):
-                            doc[k].append(v)
-                            modified = True
-
-                # Apply $pull
-                if "$pull" in update:
-                    for k, v in update["$pull"].items():
-                        if k in doc and isinstance(doc[k], list):
-                            old_len = len(doc[k])
-                            if isinstance(v, dict):
-                                # match items that contain all key-values from v
-                                doc[k] = [item for item in doc[k] if not all(item.get(sub_k) == sub_v for sub_k, sub_v in v.items())]
-                            else:
-                                doc[k] = [item for item in doc[k] if item != v]
-                            if len(doc[k]) != old_len:
-                                modified = True
-
+                modified = self._update_indexed(doc, update)
                 if modified:
-                    self._save_collection_data(data)
+                    self._save_collection_data(data, "u", [doc], update)
                     return MockUpdateResult(1, 1)
                 else:
                     return MockUpdateResult(1, 0)
+        if upsert:
+            document = _upsert_document(filter_query, update)
+            self._index_insert(document)
+            data.append(document)
+            self._save_collection_data(data, "i", [document])
+            return MockUpdateResult(0, 0, document.get("_id"))
         return MockUpdateResult(0, 0)
 
+    @_exclusive
     async def update_many(self, filter_query, update):
         data = self._get_collection_data()
-        updated_count = 0
-        for doc in data:
-            if self._matches(doc, filter_query):
-                # Apply $set
-                if "$set" in update:
-                    for k, v in update["$set"].items():
-                        doc[k] = v
-                
-                # Apply $push
-                if "$push" in update:
-                    for k, v in update["$push"].items():
-                        if k not in doc:
-                            doc[k] = []
-                        if isinstance(doc[k], list):
-                            doc[k].append(v)
-
-                # Apply $pull
-                if "$pull" in update:
-                    for k, v in update["$pull"].items():
-                        if k in doc and isinstance(doc[k], list):
-                            if isinstance(v, dict):
-                                doc[k] = [item for item in doc[k] if not all(item.get(sub_k) == sub_v for sub_k, sub_v in v.items())]
-                            else:
-                                doc[k] = [item for item in doc[k] if item != v]
-                
-                updated_count += 1
-        if updated_count > 0:
-            self._save_collection_data(data)
-        return MockUpdateResult(updated_count, updated_count)
+        updated = []
+        try:
+            for doc in list(self._candidates(filter_query)):
+                if self._matches(doc, filter_query):
+                    self._update_indexed(doc, update, track_changes=False)
+                    updated.append(doc)
+        finally:
+            if updated:
+                self._save_collection_data(data, "u", updated, update)
+        return MockUpdateResult(len(updated), len(updated))
 
+    @_exclusive
     async def delete_one(self, filter_query):
         data = self._get_collection_data()
-        for i, doc in enumerate(data):
+        for doc in self._candidates(filter_query):
             if self._matches(doc, filter_query):
-                del data[i]
-                self._save_collection_data(data)
+                for i, stored in enumerate(data):
+                    if stored is doc:
+                        del data[i]
+                        break
+                self._index_remove(doc)
+                self._save_collection_data(data, "d", [doc])
                 return True
         return False
 
+    @_exclusive
     async def delete_many(self, filter_query):
         data = self._get_collection_data()
-        new_data = [doc for doc in data if not self._matches(doc, filter_query)]
+        doomed = {id(doc): doc for doc in self._candidates(filter_query) if self._matches(doc, filter_query)}
+        new_data = [doc for doc in data if id(doc) not in doomed]
+        for doc in doomed.values():
+            self._index_remove(doc)
         deleted_count = len(data) - len(new_data)
-        self._save_collection_data(new_data)
+        self._save_collection_data(new_data, "d", list(doomed.values()))
         return deleted_count
 
 class AsyncMockDatabase:
     def __init__(self, client, name):
         self.client = client
         self.name = name
-        self.data = client.data.get(name, {})
+        self.data = client.data.setdefault(name, {})
+        # collection name -> {field: MockIndex}, shared by every handle of this database
+        self.indexes: Dict[str, Dict[str, MockIndex]] = client.indexes.setdefault(name, {})
 
     def __getitem__(self, name):
+        # A lazy handle: the file is read off the event loop by the first query or write
         return AsyncMockCollection(self, name)
     
     def __getattr__(self, name):
         return self[name]
 
-    def _save(self):
-        self.client.data[self.name] = self.data
-        self.client._save()
+    def _persist(self, collection, op, docs, update=None):
+        self.client._persist(self.name, collection, op, docs, update)
+
+class MockCollectionFile:
+    """On-disk state of one collection: `<storage_dir>/<db>/<collection>.json` (or .msgpack) plus its journal."""
+
+    def __init__(self, client, db_name, name):
+        self.client = client
+        self.db_name = db_name
+        self.name = name
+        directory = os.path.join(client.storage_dir, db_name)
+        self.path = os.path.join(directory, name + client.codec.ext)
+        self.journal_path = os.path.join(directory, name + ".journal")
+        self.lock_path = os.path.join(directory, name + ".lock")
+        self.dirty = False
+        # Whether the file has been read; the first access loads it under load_lock
+        self.loaded = False
+        self.load_lock = None
+        # Multi-process mode: stat of the file as last read or written, and the write lock
+        self.signature = None
+        self.lock = None
+        self.lock_fd = None
+        # Journal records point at documents by a sequence number (their
+        # position in the last snapshot, or insertion order after it)
+        self.generation = 0
+        self.seqs: Dict[int, int] = {}
+        self.by_seq: Dict[int, Dict[str, Any]] = {}
+        self.next_seq = 0
+        self.journal_file = None
+        self.journal_records = 0
+
+    @property
+    def docs(self) -> List[Dict[str, Any]]:
+        return self.client.data.setdefault(self.db_name, {}).setdefault(self.name, [])
+
+    def load(self):
+        docs = []
+        self.signature = self.stat()
+        path, codec = self.path, self.client.codec
+        if not os.path.exists(path):
+            # Written with another codec: read it and convert below
+            path, codec = self.other_format()
+        if path is not None:
+            try:
+                with open(path, 'rb') as f:
+                    stored = codec.loads(f.read())
+            except Exception as e:
+                # Keep the unreadable file for recovery instead of overwriting it on the next save
+                corrupt_path = f"{path}.corrupt-{int(time.time())}"
+                logging.error(f"Mock DB file {path} is unreadable ({e}), moved to {corrupt_path}")
+                os.replace(path, corrupt_path)
+                path, stored = None, []
+            # Journal mode wraps the documents together with the journal generation
+            if isinstance(stored, dict):
+                self.generation = stored.get("generation", 0)
+                stored = stored.get("documents", [])
+            docs = stored
+        self.client.data.setdefault(self.db_name, {})[self.name] = docs
+        if self.client.journal:
+            self.number_documents()
+            self.open_journal(self.replay_journal())
+        if path is not None and path != self.path:
+            if self.client.journal:
+                self.compact()
+            else:
+                self.save()
+            os.remove(path)
+            logging.warning(f"Mock DB file {path} converted to {self.path}")
+        self.loaded = True
+
+    def other_format(self):
+        """(path, codec) of this collection stored with a different codec, or (None, None)."""
+        base = os.path.splitext(self.path)[0]
+        for codec in (JsonCodec(), MsgpackCodec()):
+            path = base + codec.ext
+            if path != self.path and os.path.exists(path):
+                if codec.name == "msgpack" and msgpack is None:
+                    logging.error(f"Mock DB file {path} needs msgpack, which is not installed")
+                    continue
+                return path, codec
+        return None, None
+
+    def snapshot(self, copy=False):
+        """The data to write out. copy=True detaches it from later in-place edits (for threaded writes)."""
+        docs = self.docs
+        if copy:
+            docs = [dict(doc) for doc in docs]
+        if self.client.journal:
+            return {"generation": self.generation, "documents": docs}
+        return docs
+
+    def write(self, data):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.client._write_file(self.path, data)
+        self.signature = self.stat()
+
+    def save(self):
+        self.write(self.snapshot())
+        self.dirty = False
+
+    # ===== Multi-process mode =====
+
+    def stat(self):
+        # Every save replaces the file, so the inode changes along with the content
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def changed_on_disk(self) -> bool:
+        return self.stat() != self.signature
+
+    async def acquire(self):
+        """Exclusive write access: an asyncio lock within the process plus flock on `<collection>.lock` across processes."""
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        await self.lock.acquire()
+        try:
+            if self.lock_fd is None:
+                os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+                self.lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            while True:
+                try:
+                    fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    await asyncio.sleep(0.002)
+        except BaseException:
+            self.lock.release()
+            raise
+
+    def release(self):
+        fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+        self.lock.release()
+
+    # ===== Journal =====
+
+    def record(self, op, docs, update=None):
+        record = {"op": op}
+        if op == "i":
+            for doc in docs:
+                self.track(doc)
+            record["docs"] = docs
+        elif op == "u":
+            record["s"] = [self.seqs[id(doc)] for doc in docs]
+            record["u"] = update
+        elif op == "d":
+            record["s"] = [self.seqs[id(doc)] for doc in docs]
+            for doc in docs:
+                self.untrack(doc)
+        self.append(record)
+
+    def track(self, doc):
+        seq = self.next_seq
+        self.next_seq += 1
+        self.seqs[id(doc)] = seq
+        self.by_seq[seq] = doc
+
+    def untrack(self, doc):
+        seq = self.seqs.pop(id(doc), None)
+        self.by_seq.pop(seq, None)
+
+    def number_documents(self):
+        self.seqs = {}
+        self.by_seq = {}
+        self.next_seq = 0
+        for doc in self.docs:
+            self.track(doc)
+
+    def replay_journal(self) -> bool:
+        """Applies the journal on top of the snapshot. Returns False if there was no usable journal."""
+        if not os.path.exists(self.journal_path):
+            return False
+        with open(self.journal_path, 'r', encoding='utf-8') as f:
+            try:
+                header = self.client.codec.loads_line(f.readline())
+            except ValueError:
+                return False
+            # Journal from before the last compaction: its records are already in the snapshot
+            if header.get("generation") != self.generation:
+                return False
+            for line in f:
+                try:
+                    record = self.client.codec.loads_line(line)
+                except ValueError:
+                    # Torn last record from a crash mid-append
+                    break
+                self.apply_record(record)
+                self.journal_records += 1
+        return True
+
+    def apply_record(self, record):
+        docs = self.docs
+        if record["op"] == "i":
+            for doc in record["docs"]:
+                docs.append(doc)
+                self.track(doc)
+        elif record["op"] == "u":
+            for seq in record["s"]:
+                doc = self.by_seq.get(seq)
+                if doc is not None:
+                    _apply_update(doc, record["u"], track_changes=False)
+        elif record["op"] == "d":
+            doomed = {id(self.by_seq[seq]) for seq in record["s"] if seq in self.by_seq}
+            docs[:] = [doc for doc in docs if id(doc) not in doomed]
+            for seq in record["s"]:
+                doc = self.by_seq.get(seq)
+                if doc is not None:
+                    self.untrack(doc)
+
+    def open_journal(self, append=True):
+        if self.journal_file is not None:
+            self.journal_file.close()
+        os.makedirs(os.path.dirname(self.journal_path), exist_ok=True)
+        if append:
+            self.journal_file = open(self.journal_path, 'a', encoding='utf-8')
+        else:
+            self.journal_file = open(self.journal_path, 'w', encoding='utf-8')
+            self.journal_file.write(json.dumps({"generation": self.generation}) + "\n")
+            self.journal_file.flush()
+            self.journal_records = 0
+
+    def append(self, record):
+        self.journal_file.write(self.client.codec.dumps_line(record) + "\n")
+        self.journal_file.flush()
+        self.journal_records += 1
+
+    def compact(self):
+        """Writes a fresh snapshot and starts an empty journal."""
+        self.generation += 1
+        # Snapshot first: a crash before the journal is reset leaves a stale
+        # journal whose generation no longer matches, so it is ignored on load
+        self.save()
+        self.number_documents()
+        self.open_journal(append=False)
+
+    def close(self):
+        if self.journal_file is not None:
+            if self.journal_records:
+                self.compact()
+            self.journal_file.close()
+            self.journal_file = None
+        if self.lock_fd is not None:
+            os.close(self.lock_fd)
+            self.lock_fd = None
 
 class AsyncMockClient:
-    def __init__(self, filepath="local_db.json"):
+    """JSON-file backed stand-in for AsyncIOMotorClient.
+
+    Each collection lives in its own file, `<storage_dir>/<db>/<collection>.json`
+    (storage_dir defaults to the filepath without its extension plus ".d"),
+    read on first access and written on its own. A legacy single-file
+    database at filepath is split into that layout on startup.
+
+    By default every write schedules a rewrite of the collection's file;
+    a background task serializes it in a worker thread, so writes that land
+    while a save is running are coalesced into the next one (without a
+    running event loop the file is written on the spot). With journal=True
+    each write is appended to `<collection>.journal` as one compact record
+    and the file is only rewritten by the periodic compaction, which also
+    truncates the journal. On load the journal is replayed on top of the
+    snapshot.
+
+    With flush_interval set (and no journal), writes only mark their
+    collection dirty; a background task writes the dirty collections once
+    per interval or once flush_max_ops writes have piled up, serializing
+    them in a worker thread. Files always go through a temp file and
+    os.replace, with an optional fsync.
+
+    Files are compact JSON by default. codec="orjson" uses orjson for the
+    same files, codec="msgpack" stores `<collection>.msgpack` instead; a
+    collection saved with another codec is converted on load. pretty=True
+    keeps the indented JSON format for debugging.
+
+    shared=True lets several processes (uvicorn --workers N) use the same
+    storage_dir. Every read first checks whether the collection file was
+    replaced by another process and reloads it if so. Every write takes
+    an flock on `<collection>.lock`, reloads, applies the change and saves
+    the file before unlocking. journal and flush_interval do not apply in
+    this mode. Needs fcntl (Unix).
+    """
+
+    def __init__(self, filepath="local_db.json", journal=False, compact_interval=60.0, journal_max_records=10000,
+                 flush_interval=None, flush_max_ops=1000, fsync=False, storage_dir=None, codec="json", pretty=False,
+                 shared=False):
+        if shared and journal:
+            raise ValueError("Mock DB shared mode does not support the journal")
+        if shared and fcntl is None:
+            raise RuntimeError("Mock DB shared mode needs fcntl, which this platform lacks")
         self.filepath = filepath
+        self.storage_dir = storage_dir or os.path.splitext(filepath)[0] + ".d"
+        self.journal = journal
+        self.compact_interval = compact_interval
+        self.journal_max_records = journal_max_records
+        self.flush_interval = flush_interval
+        self.flush_max_ops = flush_max_ops
+        self.fsync = fsync
+        self.codec = get_codec(codec, pretty)
+        self.shared = shared
         self.data = {}
-        self._load()
+        # db name -> collection name -> {field: MockIndex}
+        self.indexes: Dict[str, Dict[str, Dict[str, MockIndex]]] = {}
+        self._files: Dict[tuple, MockCollectionFile] = {}
+        self._compactor = None
+        self._compact_requested = None
+        # Group commit state: writes since the last flush
+        self._pending_ops = 0
+        self._flusher = None
+        self._flush_requested = None
+        self._flush_lock = asyncio.Lock()
+        with self._storage_lock():
+            self._migrate_single_file()
+
+    @contextlib.contextmanager
+    def _storage_lock(self):
+        """Shared mode: only one process migrates the legacy file."""
+        if not self.shared:
+            yield
+            return
+        os.makedirs(self.storage_dir, exist_ok=True)
+        fd = os.open(os.path.join(self.storage_dir, ".lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def _collection_file(self, db_name, name) -> MockCollectionFile:
+        key = (db_name, name)
+        collection_file = self._files.get(key)
+        if collection_file is None:
+            collection_file = MockCollectionFile(self, db_name, name)
+            self._files[key] = collection_file
+        return collection_file
+
+    def _migrate_single_file(self):
+        """Splits a legacy local_db.json (plus its journal) into per-collection files."""
+        if not os.path.isfile(self.filepath):
+            return
+        try:
+            with open(self.filepath, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except Exception as e:
+            logging.error(f"Mock DB file {self.filepath} is unreadable ({e}), not migrating it")
+            return
+
+        meta = data.pop(JOURNAL_META_KEY, None) or {}
+        files = []
+        for db_name, collections in data.items():
+            for name, docs in collections.items():
+                collection_file = MockCollectionFile(self, db_name, name)
+                self.data.setdefault(db_name, {})[name] = docs
+                collection_file.number_documents()
+                self._files[(db_name, name)] = collection_file
+                files.append(collection_file)
+
+        legacy_journal = self.filepath + ".journal"
+        if os.path.exists(legacy_journal):
+            with open(legacy_journal, 'r', encoding='utf-8') as f:
+                try:
+                    header = json.loads(f.readline())
+                except ValueError:
+                    header = {}
+                if header.get("generation") == meta.get("generation", 0):
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            break
+                        key = (record["db"], record["c"])
+                        if key not in self._files:
+                            self._files[key] = MockCollectionFile(self, *key)
+                            self.data.setdefault(key[0], {})[key[1]] = []
+                            files.append(self._files[key])
+                        self._files[key].apply_record(record)
+
+        for collection_file in files:
+            collection_file.loaded = True
+            collection_file.save()
+            if self.journal:
+                collection_file.number_documents()
+                collection_file.open_journal(append=False)
+            else:
+                collection_file.seqs, collection_file.by_seq = {}, {}
+        os.replace(self.filepath, self.filepath + ".migrated")
+        if os.path.exists(legacy_journal):
+            os.replace(legacy_journal, legacy_journal + ".migrated")
+        logging.warning(f"Mock DB migrated from {self.filepath} to per-collection files in {self.storage_dir}")
 
-    def _load(self):
-        if os.path.exists(self.filepath):
+    def _write_file(self, path, data):
+        tmp_path = path + ".tmp"
+        raw = self.codec.dumps(data)
+        with open(tmp_path, 'wb') as f:
+            f.write(raw)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        if self.fsync and hasattr(os, "O_DIRECTORY"):
+            dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
             try:
-                with open(self.filepath, 'r', encoding='utf-8') as f:
-                    self.data = json.load(f)
-            except:
-                self.data = {}
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    def _persist(self, db_name, collection, op, docs, update=None):
+        collection_file = self._collection_file(db_name, collection)
+        if self.shared:
+            # Saved by the write itself, still holding the collection lock
+            collection_file.dirty = True
+        elif self.journal:
+            if docs:
+                collection_file.record(op, docs, update)
+                self._after_journal_append(collection_file)
         else:
-            self.data = {}
+            self._mark_dirty(collection_file)
+            if not self.flush_interval and self._flush_requested is not None:
+                self._flush_requested.set()
+
+    # ===== Journal compaction =====
+
+    def _after_journal_append(self, collection_file):
+        if self._compactor is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                loop = None
+            if loop is not None:
+                self._compact_requested = asyncio.Event()
+                self._compactor = loop.create_task(self._compact_periodically())
+        if collection_file.journal_records >= self.journal_max_records and self._compact_requested is not None:
+            self._compact_requested.set()
+
+    def compact(self):
+        """Folds every non-empty journal into its collection file."""
+        for collection_file in list(self._files.values()):
+            if collection_file.journal_records:
+                collection_file.compact()
+
+    async def _compact_periodically(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._compact_requested.wait(), timeout=self.compact_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._compact_requested.clear()
+            try:
+                self.compact()
+            except Exception as e:
+                logging.error(f"Mock DB compaction failed: {e}")
+
+    # ===== Group commit =====
+
+    def _mark_dirty(self, collection_file):
+        collection_file.dirty = True
+        self._pending_ops += 1
+        if self._flusher is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                # No loop to flush from (e.g. a script): write through
+                collection_file.save()
+                self._pending_ops = 0
+                return
+            self._flush_requested = asyncio.Event()
+            self._flusher = loop.create_task(self._flush_periodically())
+        if self._pending_ops >= self.flush_max_ops:
+            self._flush_requested.set()
+
+    async def flush(self):
+        """Writes pending changes now, off the event loop."""
+        async with self._flush_lock:
+            dirty = [f for f in self._files.values() if f.dirty]
+            if not dirty:
+                return
+            snapshots = [(f, f.snapshot(copy=True)) for f in dirty]
+            for collection_file in dirty:
+                collection_file.dirty = False
+            self._pending_ops = 0
+            try:
+                await asyncio.to_thread(self._write_snapshots, snapshots)
+            except Exception:
+                for collection_file in dirty:
+                    collection_file.dirty = True
+                raise
 
-    def _save(self):
-        with open(self.filepath, 'w', encoding='utf-8') as f:
-            json.dump(self.data, f, indent=2, ensure_ascii=False)
+    @staticmethod
+    def _write_snapshots(snapshots):
+        for collection_file, data in snapshots:
+            collection_file.write(data)
+
+    async def _flush_periodically(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Mock DB flush failed: {e}")
+
+    async def preload(self, db_name, names):
+        """Reads the named collections of db_name now, so the first requests don't wait for them.
+
+        Other collections are still read on first use.
+        """
+        database = self[db_name]
+        for name in names:
+            await database[name]._ensure_loaded()
 
     def __getitem__(self, name):
         return AsyncMockDatabase(self, name)
 
     def close(self):
-        pass
+        for task in (self._flusher, self._compactor):
+            if task is not None:
+                task.cancel()
+        self._flusher = None
+        self._compactor = None
+        for collection_file in self._files.values():
+            if collection_file.dirty:
+                collection_file.save()
+            collection_file.close()
+        self._pending_ops = 0
@@ -1,19 +1,33 @@
 from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Query, Request, WebSocket, WebSocketDisconnect, Response # Final Reload 4
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.responses import StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 try:
     from mock_db import AsyncMockClient
 except ImportError:
     raise
+from sqlite_db import AsyncSQLiteClient
+from analytics_engine import ColumnArchive, EventColumns, GRANULARITIES, histogram, top_targets
+from geoip import GeoIPTable, GeoResult
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, EmailStr
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Literal
 import uuid
+import hashlib
+import ipaddress
+import math
+import csv
+import io
+import json
+from collections import OrderedDict, deque
+from urllib.parse import unquote
 from datetime import datetime, timezone, timedelta
 import bcrypt
 from jose import JWTError, jwt
@@ -44,14 +58,42 @@ for directory in [UPLOAD_DIR, AVATARS_DIR, COVERS_DIR, LOGO_DIR, FAVS_DIR, OG_PR
 
 mongo_url = os.getenv('MONGO_URL', 'mongodb://localhost:27017')
 USE_MOCK_DB = os.getenv('USE_MOCK_DB', 'true').lower() == 'true'
+# SQLite storage (takes precedence over USE_MOCK_DB): durable and indexed, no MongoDB needed
+USE_SQLITE_DB = os.getenv('USE_SQLITE_DB', 'false').lower() == 'true'
+SQLITE_DB_PATH = os.getenv('SQLITE_DB_PATH', 'local_db.sqlite3')
 DB_FILE_PATH = os.getenv('DB_FILE_PATH', 'local_db.json')
+# Append writes to DB_FILE_PATH.journal instead of rewriting the whole file
+MOCK_DB_JOURNAL = os.getenv('MOCK_DB_JOURNAL', 'false').lower() == 'true'
+# Group commit: flush the mock DB in the background every N seconds instead of on each write
+MOCK_DB_FLUSH_INTERVAL = float(os.getenv('MOCK_DB_FLUSH_INTERVAL', '0')) or None
+MOCK_DB_FSYNC = os.getenv('MOCK_DB_FSYNC', 'false').lower() == 'true'
+# Mock DB file format: json (compact), orjson or msgpack; MOCK_DB_PRETTY=true keeps indented JSON for debugging
+MOCK_DB_CODEC = os.getenv('MOCK_DB_CODEC', 'json')
+MOCK_DB_PRETTY = os.getenv('MOCK_DB_PRETTY', 'false').lower() == 'true'
+# Let several uvicorn workers share the mock DB files (on by default when WEB_CONCURRENCY > 1)
+MOCK_DB_SHARED = os.getenv('MOCK_DB_SHARED', 'true' if int(os.getenv('WEB_CONCURRENCY', '1')) > 1 else 'false').lower() == 'true'
 
 client = None
 db = None
 
-if USE_MOCK_DB:
+def create_mock_client():
+    return AsyncMockClient(
+        DB_FILE_PATH,
+        journal=MOCK_DB_JOURNAL,
+        flush_interval=MOCK_DB_FLUSH_INTERVAL,
+        fsync=MOCK_DB_FSYNC,
+        codec=MOCK_DB_CODEC,
+        pretty=MOCK_DB_PRETTY,
+        shared=MOCK_DB_SHARED,
+    )
+
+if USE_SQLITE_DB:
+    logging.warning(f"Using SQLite DB ({SQLITE_DB_PATH})")
+    client = AsyncSQLiteClient(SQLITE_DB_PATH)
+    db = client[os.getenv('DB_NAME', 'my_local_db')]
+elif USE_MOCK_DB:
     logging.warning(f"Using Mock DB ({DB_FILE_PATH})")
-    client = AsyncMockClient(DB_FILE_PATH)
+    client = create_mock_client()
     db = client[os.getenv('DB_NAME', 'my_local_db')]
 else:
     try:
@@ -64,9 +106,89 @@ else:
     except Exception as e:
         logging.error(f"MongoDB connection failed: {e}")
         logging.warning(f"Falling back to Mock DB ({DB_FILE_PATH})")
-        client = AsyncMockClient(DB_FILE_PATH)
+        client = create_mock_client()
         db = client[os.getenv('DB_NAME', 'my_local_db')]
 
+# ===== Timestamps =====
+# The time-series collections (analytics_v2, notifications, password_resets)
+# store native times: BSON datetimes on MongoDB, epoch milliseconds in the
+# mock DB and SQLite, which have no date type. ISO strings written before
+# the migration are read everywhere until TimestampMigration converts them.
+
+def _db_time(moment: Optional[datetime] = None):
+    """A time (now by default) in the storage format of the time-series collections."""
+    moment = moment or datetime.now(timezone.utc)
+    if isinstance(client, AsyncIOMotorClient):
+        return moment
+    return int(moment.timestamp() * 1000)
+
+def _parse_time(value) -> Optional[datetime]:
+    """Reads a stored time in any format: datetime, epoch milliseconds or ISO string. Naive times are UTC."""
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value / 1000, tz=timezone.utc)
+    moment = value if isinstance(value, datetime) else datetime.fromisoformat(value)
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+async def _find_by_time(collection, query: dict, projection: Optional[dict], field: str, direction: int = 1,
+                        limit: Optional[int] = None, batch_size: int = 100):
+    """Yields the documents of query ordered by a time field that may still hold legacy ISO strings.
+
+    No backend sorts native times and strings together, so until the
+    timestamp migration is done each kind is sorted by the DB on its own
+    and the two streams are merged here by the parsed time.
+    """
+    def moment(doc):
+        try:
+            return _parse_time(doc.get(field)) or _EPOCH
+        except ValueError:
+            return _EPOCH
+
+    streams = []
+    for kind in ({"$type": ["date", "number"]}, {"$type": "string"}):
+        match = {"$and": [query, {field: kind}]} if field in query else {**query, field: kind}
+        cursor = collection.find(match, projection).sort(field, direction).batch_size(batch_size)
+        if limit:
+            cursor = cursor.limit(limit)
+        streams.append(cursor.__aiter__())
+    heads = [await anext(stream, None) for stream in streams]
+    pick = min if direction > 0 else max
+    count = 0
+    while any(head is not None for head in heads) and not (limit and count >= limit):
+        i = pick((i for i, head in enumerate(heads) if head is not None), key=lambda i: moment(heads[i]))
+        yield heads[i]
+        count += 1
+        heads[i] = await anext(streams[i], None)
+
+def _iso_time(value) -> Optional[str]:
+    try:
+        moment = _parse_time(value)
+    except ValueError:
+        # Not a time at all: pass it through as it is
+        return str(value)
+    return moment.isoformat() if moment else None
+
+def _time_range(field: str, start: Optional[datetime] = None, end: Optional[datetime] = None) -> dict:
+    """Filter for start <= field < end that matches native and legacy ISO string times alike."""
+    native, legacy = {}, {}
+    if start:
+        native["$gte"], legacy["$gte"] = _db_time(start), start.isoformat()
+    if end:
+        native["$lt"], legacy["$lt"] = _db_time(end), end.isoformat()
+    return {"$or": [{field: native}, {field: legacy}]}
+
+def _time_bucket_expr(field: str, length: int = 10) -> dict:
+    # Aggregation expression for the UTC day (length 10) or hour (length 13) of a time in any format
+    date_format = {10: "%Y-%m-%d", 13: "%Y-%m-%dT%H"}[length]
+    return {"$cond": [
+        {"$eq": [{"$type": f"${field}"}, "string"]},
+        {"$substrBytes": [f"${field}", 0, length]},
+        {"$dateToString": {"date": {"$toDate": f"${field}"}, "format": date_format}}
+    ]}
+
 app = FastAPI()
 
 # ===== CORS =====
@@ -88,13 +210,13 @@ import time as _time
 
 _rate_store: Dict[str, list] = defaultdict(list)
 
-def _rate_limit_check(key: str, max_requests: int, window_seconds: int):
-    """Raises 429 if rate limit exceeded."""
+def _rate_limit_check(key: str, max_requests: int, window_seconds: int, cost: int = 1):
+    """Raises 429 if rate limit exceeded. cost counts one call as several requests (e.g. a batch of events)."""
     now = _time.time()
     _rate_store[key] = [t for t in _rate_store[key] if now - t < window_seconds]
-    if len(_rate_store[key]) >= max_requests:
+    if len(_rate_store[key]) + cost > max_requests:
         raise HTTPException(status_code=429, detail="Слишком много запросов. Попробуйте позже.")
-    _rate_store[key].append(now)
+    _rate_store[key].extend([now] * cost)
 
 api_router = APIRouter(prefix="/api")
 
@@ -176,8 +298,43 @@ async def websocket_endpoint(websocket: WebSocket, username: str):
 
 OWNER_EMAIL = os.getenv("OWNER_EMAIL", "")
 
+# (collection, keys, options) — applied on both Mongo and the mock DB
+DB_INDEXES = [
+    ("users", "email", {"unique": True}),
+    ("users", "id", {"unique": True}),
+    ("pages", "username", {"unique": True}),
+    ("pages", "user_id", {}),
+    ("pages", "id", {"unique": True}),
+    ("blocks", "page_id", {}),
+    ("blocks", "id", {"unique": True}),
+    ("analytics_v2", [("page_id", 1), ("timestamp", 1)], {}),
+    # Makes a retried buffer flush skip the events that were already stored
+    ("analytics_v2", "id", {"unique": True}),
+    ("analytics_v2", "timestamp", {}),
+    # Removes raw events once the retention sweep has compacted them (MongoDB only; no-op index elsewhere)
+    ("analytics_v2", "expire_at", {"expireAfterSeconds": 0}),
+    ("analytics_daily", "id", {"unique": True}),
+    ("analytics_daily", [("page_id", 1), ("day", 1)], {}),
+    ("analytics_buckets", "id", {"unique": True}),
+    ("analytics_buckets", [("page_id", 1), ("bucket", 1)], {}),
+    ("leases", "id", {"unique": True}),
+    ("counters", "id", {"unique": True}),
+    ("events", "page_id", {}),
+    ("showcases", "page_id", {}),
+    ("leads", "page_id", {}),
+    ("notifications", "user_id", {}),
+    # Expired password reset tokens are removed by MongoDB (no-op index elsewhere)
+    ("password_resets", "expires_at", {"expireAfterSeconds": 0}),
+]
+
+MOCK_DB_PRELOAD = ("users", "pages", "blocks")
+
 @app.on_event("startup")
 async def startup_db_check():
+    # Read the small collections every page view needs before the first requests; the rest load on first use
+    if isinstance(client, AsyncMockClient):
+        await client.preload(db.name, MOCK_DB_PRELOAD)
+
     # Ensure owner has admin rights (email from env, not hardcoded)
     if OWNER_EMAIL:
         try:
@@ -189,25 +346,25 @@ async def startup_db_check():
         except Exception as e:
             logger.warning(f"Startup owner check failed: {e}")
 
-    # Create MongoDB indexes for performance
-    if not USE_MOCK_DB:
+    # Create indexes for performance (Mongo, and hash indexes in the mock DB)
+    for collection, keys, options in DB_INDEXES:
         try:
-            await db.users.create_index("email", unique=True)
-            await db.users.create_index("id", unique=True)
-            await db.pages.create_index("username", unique=True)
-            await db.pages.create_index("user_id")
-            await db.pages.create_index("id", unique=True)
-            await db.blocks.create_index("page_id")
-            await db.blocks.create_index("id", unique=True)
-            await db.analytics_v2.create_index([("page_id", 1), ("event_type", 1)])
-            await db.analytics_v2.create_index("timestamp")
-            await db.events.create_index("page_id")
-            await db.showcases.create_index("page_id")
-            await db.leads.create_index("page_id")
-            await db.notifications.create_index("user_id")
-            logger.info("MongoDB indexes created/verified")
+            await db[collection].create_index(keys, **options)
         except Exception as e:
-            logger.warning(f"Index creation warning: {e}")
+            logger.warning(f"Index creation warning ({collection} {keys}): {e}")
+    logger.info("DB indexes created/verified")
+
+    await known_page_ids.load()
+    known_page_ids.start()
+    try:
+        await geo_ip.load()
+    except Exception as e:
+        logger.warning(f"GeoIP table not loaded: {e}")
+    geo_ip.start()
+    analytics_buffer.start()
+    analytics_retention.start()
+    if TIMESTAMP_MIGRATION == "auto":
+        timestamp_migration.start()
     
     # Start Telegram Bot polling in background
     if bot and dp:
@@ -408,25 +565,55 @@ class ConnectionManager:
 manager = ConnectionManager()
 
 # Helper to fetch full data (internal)
+
+# Owner fields a public page exposes: the analytics pixel ids
+PAGE_OWNER_FIELDS = ("ga_pixel_id", "fb_pixel_id", "vk_pixel_id")
+PAGE_OWNER_PROJECTION = {"_id": 0, **{field: 1 for field in PAGE_OWNER_FIELDS}}
+PAGE_ITEMS_LIMIT = 100
+# On MongoDB, assemble the page with one $lookup aggregation instead of one query per collection
+PAGE_DATA_LOOKUP = os.getenv('PAGE_DATA_LOOKUP', 'false').lower() == 'true'
+
+def _page_items_lookup(collection: str, sort: Optional[dict] = None) -> dict:
+    pipeline = ([{"$sort": sort}] if sort else []) + [{"$limit": PAGE_ITEMS_LIMIT}, {"$project": {"_id": 0}}]
+    return {"$lookup": {"from": collection, "localField": "id", "foreignField": "page_id", "pipeline": pipeline, "as": collection}}
+
+def _page_data_pipeline(username: str) -> List[dict]:
+    return [
+        {"$match": {"username": username}},
+        {"$limit": 1},
+        _page_items_lookup("blocks", {"order": 1}),
+        _page_items_lookup("events"),
+        _page_items_lookup("showcases"),
+        {"$lookup": {
+            "from": "users", "localField": "user_id", "foreignField": "id",
+            "pipeline": [{"$limit": 1}, {"$project": PAGE_OWNER_PROJECTION}], "as": "owner"
+        }},
+        {"$project": {"_id": 0}},
+    ]
+
 async def get_full_page_data_internal(username: str):
-    page = await db.pages.find_one({"username": username}, {"_id": 0})
-    if not page:
-        return None
-    
-    blocks = await db.blocks.find({"page_id": page["id"]}, {"_id": 0}).sort("order", 1).to_list(100)
-    events = await db.events.find({"page_id": page["id"]}, {"_id": 0}).to_list(100)
-    showcases = await db.showcases.find({"page_id": page["id"]}, {"_id": 0}).to_list(100)
-    
+    if PAGE_DATA_LOOKUP and isinstance(client, AsyncIOMotorClient):
+        result = await db.pages.aggregate(_page_data_pipeline(username)).to_list(1)
+        if not result:
+            return None
+        page = result[0]
+        blocks, events, showcases = page.pop("blocks"), page.pop("events"), page.pop("showcases")
+        owners = page.pop("owner")
+        user = owners[0] if owners else None
+    else:
+        page = await db.pages.find_one({"username": username}, {"_id": 0})
+        if not page:
+            return None
+        # Everything else only depends on the page, so it is fetched concurrently
+        blocks, events, showcases, user = await asyncio.gather(
+            db.blocks.find({"page_id": page["id"]}, {"_id": 0}).sort("order", 1).to_list(PAGE_ITEMS_LIMIT),
+            db.events.find({"page_id": page["id"]}, {"_id": 0}).to_list(PAGE_ITEMS_LIMIT),
+            db.showcases.find({"page_id": page["id"]}, {"_id": 0}).to_list(PAGE_ITEMS_LIMIT),
+            db.users.find_one({"id": page["user_id"]}, PAGE_OWNER_PROJECTION),
+        )
+
     # Inject user's global analytics IDs
-    user = await db.users.find_one({"id": page["user_id"]})
-    analytics = {}
-    if user:
-        if user.get("ga_pixel_id"):
-             analytics["ga_pixel_id"] = user.get("ga_pixel_id")
-        if user.get("fb_pixel_id"):
-             analytics["fb_pixel_id"] = user.get("fb_pixel_id")
-        if user.get("vk_pixel_id"):
-             analytics["vk_pixel_id"] = user.get("vk_pixel_id")
+    analytics = {field: user[field] for field in PAGE_OWNER_FIELDS if user and user.get(field)}
 
     return {
         "page": page,
@@ -999,6 +1186,7 @@ async def register(user_data: UserRegister, request: Request):
             "is_main_page": True
         }
         await db.pages.insert_one(page)
+        await known_page_ids.add(page["id"])
 
         # 5. Create template blocks if template provided
         if user_data.template and user_data.template in TEMPLATE_BLOCKS:
@@ -1230,7 +1418,7 @@ async def create_lead(lead_data: LeadCreate, request: Request):
         "type": "info",
         "message": f"Кто-то заполнил форму на странице {page['name']}, проверьте в настройках.",
         "read": False,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": _db_time()
     }
     await db.notifications.insert_one(notification)
 
@@ -1328,6 +1516,8 @@ async def delete_my_account(current_user: dict = Depends(get_current_user)):
     
     # 2. Delete all pages
     await db.pages.delete_many({"user_id": user_id})
+    for page in user_pages:
+        await known_page_ids.discard(page["id"])
     
     # 3. Delete user
     await db.users.delete_one({"id": user_id})
@@ -1406,8 +1596,8 @@ async def forgot_password(data: ForgotPasswordRequest, request: Request):
         "user_id": user["id"],
         "email": data.email,
         "token": reset_token,
-        "expires_at": expires_at.isoformat(),
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "expires_at": _db_time(expires_at),
+        "created_at": _db_time()
     }
     
     # Удаляем старые токены этого пользователя
@@ -1435,7 +1625,7 @@ async def reset_password_confirm(data: ResetPasswordRequest):
         raise HTTPException(status_code=400, detail="Неверный или истёкший токен")
     
     # Проверяем срок действия
-    expires_at = datetime.fromisoformat(reset_record["expires_at"])
+    expires_at = _parse_time(reset_record["expires_at"])
     if datetime.now(timezone.utc) > expires_at:
         # Удаляем истёкший токен
         await db.password_resets.delete_one({"token": data.token})
@@ -1549,6 +1739,40 @@ async def get_admin_stats(current_admin = Depends(get_current_admin)):
         "total_pages": total_pages
     }
 
+@api_router.get("/admin/analytics/buffer")
+async def get_analytics_buffer_stats(current_admin = Depends(get_current_admin)):
+    return analytics_buffer.stats()
+
+@api_router.get("/admin/analytics/retention")
+async def get_analytics_retention_stats(current_admin = Depends(get_current_admin)):
+    return analytics_retention.stats()
+
+@api_router.get("/admin/geoip")
+async def get_geoip_stats(current_admin = Depends(get_current_admin)):
+    return geo_ip.stats()
+
+@api_router.post("/admin/geoip/reload")
+async def reload_geoip(current_admin = Depends(get_current_admin)):
+    try:
+        await geo_ip.load(force=True)
+    except Exception as e:
+        logger.error(f"GeoIP table reload failed: {e}")
+        raise HTTPException(status_code=500, detail="Не удалось загрузить базу GeoIP")
+    return geo_ip.stats()
+
+@api_router.get("/admin/migrations/timestamps")
+async def get_timestamp_migration(current_admin = Depends(get_current_admin)):
+    return timestamp_migration.stats()
+
+@api_router.post("/admin/migrations/timestamps")
+async def start_timestamp_migration(current_admin = Depends(get_current_admin)):
+    timestamp_migration.start()
+    return timestamp_migration.stats()
+
+@api_router.get("/admin/analytics/stats-cache")
+async def get_stats_cache_stats(current_admin = Depends(get_current_admin)):
+    return page_stats_cache.stats()
+
 @api_router.get("/admin/users")
 async def get_all_users(current_admin = Depends(get_current_admin)):
     users = await db.users.find({}, {"_id": 0, "password": 0}).to_list(1000)
@@ -1573,8 +1797,11 @@ async def admin_delete_user(user_id: str, current_admin = Depends(get_current_ad
         raise HTTPException(status_code=400, detail="Нельзя удалить самого себя")
         
     # Cascade delete
+    user_pages = await db.pages.find({"user_id": user_id}, {"_id": 0, "id": 1}).to_list(None)
     await db.users.delete_one({"id": user_id})
     await db.pages.delete_many({"user_id": user_id})
+    for page in user_pages:
+        await known_page_ids.discard(page["id"])
     # Optional: delete blocks if page IDs are known, but pages usually enough if we reference by user_id
     # To be thorough:
     page = await db.pages.find_one({"user_id": user_id})
@@ -1634,75 +1861,1253 @@ class AnalyticsEvent(BaseModel):
     target_id: Optional[str] = None # e.g. track_id or block_id for clicks
     metadata: Optional[Dict[str, Any]] = None
 
-@api_router.post("/analytics/track")
-async def track_event(event: AnalyticsEvent, request: Request):
-    _rate_limit_check(f"track:{request.client.host}", max_requests=60, window_seconds=60)
-    # Public endpoint, no auth required to record views/clicks
-    # But we check if page exists to avoid spam
-    page = await db.pages.find_one({"id": event.page_id})
-    if not page:
-        raise HTTPException(status_code=404, detail="Page not found")
-        
-    doc = {
+# Events per IP and minute on the track endpoints; a batch is charged per event, so it can't be larger
+TRACK_RATE_LIMIT = 60
+# Same as TRACK_BATCH_MAX of the frontend queue
+TRACK_BATCH_MAX = 50
+
+class AnalyticsBatch(BaseModel):
+    events: List[AnalyticsEvent] = Field(..., max_length=TRACK_BATCH_MAX)
+
+# ===== Geo lookup =====
+
+# Proxies whose X-Forwarded-For is believed: loopback and the private networks Docker uses.
+# Keep in line with FORWARDED_ALLOW_IPS of uvicorn (see the Dockerfile), which resolves client.host first
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(network.strip())
+    for network in os.getenv("TRUSTED_PROXIES", "127.0.0.0/8,::1/128,10.0.0.0/8,172.16.0.0/12,192.168.0.0/16").split(",")
+    if network.strip()
+]
+# IP-range table (CSV or CSV.gz: start, end, country code[, country name]); without it the client's country is kept
+GEOIP_DB_PATH = os.getenv("GEOIP_DB_PATH", str(ROOT_DIR / "geoip" / "ip_country.csv"))
+GEOIP_CACHE_SIZE = int(os.getenv("GEOIP_CACHE_SIZE", "10000"))
+# How often the table file is checked for changes, in seconds
+GEOIP_RELOAD_INTERVAL = float(os.getenv("GEOIP_RELOAD_INTERVAL", "300"))
+
+def _is_trusted_proxy(host: str) -> bool:
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(address in network for network in TRUSTED_PROXIES)
+
+def _client_ip(request: Request) -> str:
+    """The visitor's address: the nearest X-Forwarded-For hop that is not one of our proxies."""
+    host = request.client.host if request.client else ""
+    if not _is_trusted_proxy(host):
+        return host
+    hops = [hop.strip() for hop in request.headers.get("x-forwarded-for", "").split(",") if hop.strip()]
+    for hop in reversed(hops):
+        if not _is_trusted_proxy(hop):
+            return hop
+    # Every hop is ours: the request came from inside the network
+    return hops[0] if hops else host
+
+class GeoIP:
+    """Country lookup from the offline IP-range table.
+
+    The table is loaded in a worker thread and swapped in whole, so lookups
+    never see a half-loaded table. A new file is picked up by the periodic
+    modification time check or by POST /admin/geoip/reload, without a restart.
+    """
+
+    def __init__(self, path: str, cache_size: int, reload_interval: float):
+        self.path = path
+        self.cache_size = cache_size
+        self.reload_interval = reload_interval
+        self.table: Optional[GeoIPTable] = None
+        self.loaded_at = None
+        self._task = None
+
+    async def load(self, force: bool = False):
+        if not self.path or not os.path.exists(self.path):
+            return
+        if not force and self.table is not None and os.path.getmtime(self.path) == self.table.mtime:
+            return
+        self.table = await asyncio.to_thread(GeoIPTable, self.path, self.cache_size)
+        self.loaded_at = datetime.now(timezone.utc).isoformat()
+        logger.info(f"GeoIP table loaded: {len(self.table)} ranges from {self.path}")
+
+    def lookup(self, ip: str) -> Optional[GeoResult]:
+        table = self.table
+        return table.lookup(ip) if table is not None else None
+
+    def start(self):
+        if self._task is None and self.reload_interval > 0:
+            self._task = asyncio.create_task(self._reload_periodically())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _reload_periodically(self):
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                await self.load()
+            except Exception as e:
+                logger.error(f"GeoIP table reload failed: {e}")
+
+    def stats(self) -> dict:
+        table = self.table
+        cache = table.lookup.cache_info() if table is not None else None
+        return {
+            "path": self.path,
+            "loaded": table is not None,
+            "ranges": len(table) if table is not None else 0,
+            "loaded_at": self.loaded_at,
+            "cache_hits": cache.hits if cache else 0,
+            "cache_misses": cache.misses if cache else 0,
+        }
+
+geo_ip = GeoIP(GEOIP_DB_PATH, GEOIP_CACHE_SIZE, GEOIP_RELOAD_INTERVAL)
+
+def _geo_metadata(metadata: Optional[Dict[str, Any]], geo: Optional[GeoResult]) -> Optional[Dict[str, Any]]:
+    # With a table the server's answer replaces whatever country the client sent
+    if geo_ip.table is None:
+        return metadata
+    metadata = {k: v for k, v in (metadata or {}).items() if k not in ("country", "flag", "country_code")}
+    if geo:
+        code, name, flag = geo
+        metadata.update(country=name, flag=flag, country_code=code)
+    return metadata or None
+
+# ===== Unique visitors =====
+# A visitor is a keyed hash of IP and User-Agent: raw IPs are never stored,
+# and without the salt the hashes can't be matched to an IP.
+
+VISITOR_SALT = hashlib.sha256(os.getenv("VISITOR_SALT", f"visitors:{SECRET_KEY}").encode()).digest()
+HLL_PRECISION = 12
+
+def _visitor_hash(request: Request) -> str:
+    fingerprint = f"{_client_ip(request)}|{request.headers.get('user-agent', '')}"
+    return hashlib.blake2b(fingerprint.encode(), digest_size=8, key=VISITOR_SALT).hexdigest()
+
+class HyperLogLog:
+    """HyperLogLog sketch over 64-bit hashes: 2^precision one-byte registers, about 1.6% error at 12.
+
+    Sketches merge by taking the register-wise maximum, so the sketches of
+    single days add up to the one of a week or a month. Stored base64-encoded
+    (4096 registers take 5.4 KB), whatever the traffic.
+    """
+
+    def __init__(self, registers: Optional[bytes] = None, precision: int = HLL_PRECISION):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(registers) if registers else bytearray(self.size)
+        self._alpha = 0.7213 / (1 + 1.079 / self.size)
+
+    @classmethod
+    def decode(cls, value: Optional[str]) -> "HyperLogLog":
+        return cls(base64.b64decode(value) if value else None)
+
+    def encode(self) -> str:
+        return base64.b64encode(bytes(self.registers)).decode("ascii")
+
+    def add(self, hash_hex: str) -> bool:
+        """Adds a visitor hash. True if a register changed."""
+        value = int(hash_hex, 16)
+        width = 64 - self.precision
+        index = value >> width
+        rank = width - (value & ((1 << width) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+            return True
+        return False
+
+    def merge(self, other: "HyperLogLog"):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self) -> int:
+        zeros = self.registers.count(0)
+        estimate = self._alpha * self.size * self.size / sum(2.0 ** -r for r in self.registers)
+        if zeros and estimate <= 2.5 * self.size:
+            # Linear counting is more accurate while many registers are empty
+            estimate = self.size * math.log(self.size / zeros)
+        return round(estimate)
+
+def _count_visitors(rollups: List[dict]) -> int:
+    sketch = HyperLogLog()
+    for rollup in rollups:
+        if rollup.get("visitors"):
+            sketch.merge(HyperLogLog.decode(rollup["visitors"]))
+    return sketch.count()
+
+# ===== Top links and UTM tuples =====
+
+TOP_K_CAPACITY = int(os.getenv("TOP_K_CAPACITY", "100"))
+# Plain counter maps of the rollups -> Space-Saving summaries replacing them
+HEAVY_HITTER_FIELDS = {"targets": "top_targets", "utm": "top_utm"}
+
+class SpaceSaving:
+    """Space-Saving heavy-hitter summary with at most capacity counters, stored as [key, count, error] lists.
+
+    Any key seen more than total/capacity times is kept, and a kept key's
+    count overestimates the true one by at most its error.
+    """
+
+    def __init__(self, entries: Optional[list] = None, capacity: int = TOP_K_CAPACITY):
+        self.capacity = capacity
+        self.counters = {key: [count, error] for key, count, error in entries or []}
+
+    @classmethod
+    def load(cls, rollup: dict, field: str, legacy: Optional[str] = None) -> "SpaceSaving":
+        summary = cls(rollup.get(field))
+        if field not in rollup and legacy:
+            # Rollups written before the summaries have a plain counter map
+            summary.update(rollup.get(legacy) or {})
+        return summary
+
+    def add(self, key: str, count: int = 1):
+        counter = self.counters.get(key)
+        if counter is not None:
+            counter[0] += count
+        elif len(self.counters) < self.capacity:
+            self.counters[key] = [count, 0]
+        else:
+            # The new key takes over the smallest counter and inherits its count as error
+            smallest = min(self.counters, key=lambda k: self.counters[k][0])
+            floor = self.counters.pop(smallest)[0]
+            self.counters[key] = [floor + count, floor]
+
+    def update(self, counts: Dict[str, int]):
+        # Largest first, so the rare keys of a batch can't evict its frequent ones
+        for key, count in sorted(counts.items(), key=lambda item: item[1], reverse=True):
+            self.add(key, count)
+
+    def to_list(self) -> list:
+        return sorted(([key, count, error] for key, (count, error) in self.counters.items()), key=lambda e: e[1], reverse=True)
+
+def _top_counts(rollups: List[dict], field: str, limit: int) -> List[tuple]:
+    """Top keys over any set of rollups, e.g. a date range: O(capacity) per rollup."""
+    legacy = next(name for name, summary in HEAVY_HITTER_FIELDS.items() if summary == field)
+    counts = {}
+    for rollup in rollups:
+        for key, (count, _) in SpaceSaving.load(rollup, field, legacy).counters.items():
+            counts[key] = counts.get(key, 0) + count
+    return sorted(counts.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+def _pop_heavy_hitters(update: dict) -> Dict[str, Dict[str, int]]:
+    """Moves the targets.* and utm.* counters out of a rollup update, for the summaries."""
+    counts = {}
+    for path in list(update["$inc"]):
+        parent, _, key = path.partition(".")
+        if parent in HEAVY_HITTER_FIELDS:
+            counts.setdefault(HEAVY_HITTER_FIELDS[parent], {})[key] = update["$inc"].pop(path)
+    return counts
+
+async def _merge_rollup_summaries(rollup_id: str, hashes: List[str], top: Dict[str, Dict[str, int]],
+                                  visitors: Optional[HyperLogLog] = None):
+    """Adds visitor hashes (or a whole visitors sketch) and heavy-hitter counts to the sketches of a rollup document.
+
+    Read-modify-write with the old sketches as the compare-and-set condition,
+    retried if another writer got in between.
+    """
+    if not hashes and not top and visitors is None:
+        return
+    projection = {"_id": 0, "visitors": 1, **{name: 1 for pair in HEAVY_HITTER_FIELDS.items() for name in pair}}
+    for _ in range(5):
+        rollup = await db.analytics_daily.find_one({"id": rollup_id}, projection)
+        if rollup is None:
+            return
+        changes, legacy_maps = {}, {}
+        sketch = HyperLogLog.decode(rollup.get("visitors"))
+        changed = False
+        for visitor in hashes:
+            changed = sketch.add(visitor) or changed
+        if visitors is not None:
+            registers = bytes(sketch.registers)
+            sketch.merge(visitors)
+            changed = changed or sketch.registers != registers
+        if changed:
+            changes["visitors"] = sketch.encode()
+        for legacy, field in HEAVY_HITTER_FIELDS.items():
+            if field in top:
+                summary = SpaceSaving.load(rollup, field, legacy)
+                summary.update(top[field])
+                changes[field] = summary.to_list()
+                if legacy in rollup:
+                    legacy_maps[legacy] = ""
+        if not changes:
+            return
+        update = {"$set": changes}
+        if legacy_maps:
+            update["$unset"] = legacy_maps
+        condition = {field: rollup.get(field) for field in changes}
+        result = await db.analytics_daily.update_one({"id": rollup_id, **condition}, update)
+        if result.matched_count:
+            return
+    logger.warning(f"Sketches of {rollup_id} not updated: too many concurrent writers")
+
+# ===== Analytics rollups =====
+# analytics_daily holds one document per page and day ("<page_id>:<YYYY-MM-DD>")
+# plus an all-time one ("<page_id>:total") with views/clicks counters and
+# per-country counts, kept up to date with $inc, a HyperLogLog sketch of the
+# visitors of view events and Space-Saving summaries of the top targets and
+# UTM tuples.
+
+ROLLUP_TOTAL_DAY = "total"
+
+def _rollup_key(value) -> str:
+    # Counters are keyed by user-supplied strings: keep ".", "$" and "|" out of field names
+    return str(value).replace("%", "%25").replace(".", "%2E").replace("$", "%24").replace("|", "%7C")
+
+def _rollup_update(event_type: str, target_id: Optional[str], metadata: Optional[Dict[str, Any]]) -> dict:
+    inc, flags = {}, {}
+    if event_type == "view":
+        inc["views"] = 1
+        meta = metadata or {}
+        country = meta.get("country")
+        if country:
+            key = _rollup_key(country)
+            inc[f"countries.{key}"] = 1
+            flags[f"flags.{key}"] = meta.get("flag", "")
+        source = meta.get("utm_source")
+        if source:
+            parts = (source, meta.get("utm_medium") or "", meta.get("utm_campaign") or "")
+            inc["utm." + "|".join(_rollup_key(part) for part in parts)] = 1
+    elif event_type == "click":
+        inc["clicks"] = 1
+        if target_id:
+            inc[f"targets.{_rollup_key(target_id)}"] = 1
+    update = {"$inc": inc}
+    if flags:
+        update["$set"] = flags
+    return update
+
+def _merge_rollup_updates(updates: List[dict]) -> dict:
+    inc, flags = {}, {}
+    for update in updates:
+        for path, amount in update["$inc"].items():
+            inc[path] = inc.get(path, 0) + amount
+        flags.update(update.get("$set", {}))
+    merged = {"$inc": inc}
+    if flags:
+        merged["$set"] = flags
+    return merged
+
+def _rollup_day_updates(docs: List[dict]):
+    """Rollup updates and visitor hashes of events, grouped by day."""
+    day_updates: Dict[str, List[dict]] = {}
+    day_visitors: Dict[str, List[str]] = {}
+    for doc in docs:
+        day = _parse_time(doc["timestamp"]).strftime("%Y-%m-%d")
+        day_updates.setdefault(day, []).append(_rollup_update(doc["event_type"], doc.get("target_id"), doc.get("metadata")))
+        if doc["event_type"] == "view" and doc.get("visitor"):
+            day_visitors.setdefault(day, []).append(doc["visitor"])
+    return day_updates, day_visitors
+
+async def _update_rollups(page_id: str, docs: List[dict], done: Optional[set] = None):
+    """Applies the rollup updates and visitor hashes of stored events of one page: one write per touched document.
+
+    Events before the cutoff of a backfill are counted by the backfill and
+    removed from docs. The $inc writes are not idempotent: done collects the
+    writes that went through, so calling again with the same docs and set
+    after a failure skips them.
+    """
+    done = set() if done is None else done
+    total_id = f"{page_id}:{ROLLUP_TOTAL_DAY}"
+    if "total" not in done:
+        # Pages get their total document from _backfill_rollups; until then the raw events are the source of truth
+        earliest = _db_time(min(_parse_time(doc["timestamp"]) for doc in docs))
+        total_update = _merge_rollup_updates([_rollup_update(d["event_type"], d.get("target_id"), d.get("metadata")) for d in docs])
+        _pop_heavy_hitters(total_update)
+        applies = {"$or": [{"cutoff": {"$exists": False}}, {"cutoff": {"$lte": earliest}}]}
+        result = await db.analytics_daily.update_one({"id": total_id, **applies}, total_update)
+        if not result.matched_count:
+            total = await db.analytics_daily.find_one({"id": total_id}, {"_id": 0, "cutoff": 1})
+            if total is None:
+                return
+            cutoff = _parse_time(total["cutoff"])
+            docs[:] = [doc for doc in docs if _parse_time(doc["timestamp"]) >= cutoff]
+            if not docs:
+                return
+            total_update = _merge_rollup_updates([_rollup_update(d["event_type"], d.get("target_id"), d.get("metadata")) for d in docs])
+            _pop_heavy_hitters(total_update)
+            await db.analytics_daily.update_one({"id": total_id}, total_update)
+        done.add("total")
+    day_updates, day_visitors = _rollup_day_updates(docs)
+    total_top = _pop_heavy_hitters(_merge_rollup_updates([update for updates in day_updates.values() for update in updates]))
+    for day, updates in day_updates.items():
+        day_update = _merge_rollup_updates(updates)
+        day_top = _pop_heavy_hitters(day_update)
+        if f"{day}:counters" not in done:
+            await db.analytics_daily.update_one(
+                {"id": f"{page_id}:{day}"},
+                {**day_update, "$setOnInsert": {"page_id": page_id, "day": day}},
+                upsert=True
+            )
+            done.add(f"{day}:counters")
+        if f"{day}:summaries" not in done:
+            await _merge_rollup_summaries(f"{page_id}:{day}", day_visitors.get(day, []), day_top)
+            done.add(f"{day}:summaries")
+    all_hashes = [visitor for hashes in day_visitors.values() for visitor in hashes]
+    await _merge_rollup_summaries(total_id, all_hashes, total_top)
+
+def _rollup_backfill_pipelines(page_id: str, claim: Optional[str] = None, bucket_length: int = 10,
+                               before: Optional[datetime] = None) -> Dict[str, list]:
+    # Everything the rollups need, grouped per day (or per hour, bucket_length 13)
+    # in the DB: only counts travel over the wire. One aggregation per grouping:
+    # targets, countries and UTM tuples are whatever clients send, so together
+    # they can outgrow the single document a $facet would return
+    day = _time_bucket_expr("timestamp", bucket_length)
+    match = {"page_id": page_id}
+    if claim is not None:
+        # Only the events a retention sweep claimed
+        match["compacted"] = claim
+    if before is not None:
+        match.update(_time_range("timestamp", end=before))
+    groupings = {
+        "events": [
+            {"$group": {"_id": {"day": day, "type": "$event_type"}, "count": {"$sum": 1}}}
+        ],
+        "targets": [
+            {"$match": {"event_type": "click", "target_id": {"$nin": [None, ""]}}},
+            {"$group": {"_id": {"day": day, "target": "$target_id"}, "count": {"$sum": 1}}}
+        ],
+        "countries": [
+            {"$match": {"event_type": "view", "metadata.country": {"$nin": [None, ""]}}},
+            {"$group": {
+                "_id": {"day": day, "country": "$metadata.country"},
+                "count": {"$sum": 1},
+                "flag": {"$last": {"$ifNull": ["$metadata.flag", ""]}}
+            }}
+        ],
+        "utm": [
+            {"$match": {"event_type": "view", "metadata.utm_source": {"$nin": [None, ""]}}},
+            {"$group": {
+                "_id": {
+                    "day": day,
+                    "source": "$metadata.utm_source",
+                    "medium": {"$ifNull": ["$metadata.utm_medium", ""]},
+                    "campaign": {"$ifNull": ["$metadata.utm_campaign", ""]}
+                },
+                "count": {"$sum": 1}
+            }}
+        ]
+    }
+    return {name: [{"$match": match}, *stages] for name, stages in groupings.items()}
+
+BACKFILL_BATCH_SIZE = 10000
+# A backfill still unfinished after this many seconds was interrupted and is started over
+BACKFILL_TIMEOUT = 600
+
+def _visitor_days_pipeline(page_id: str, before: datetime) -> list:
+    # One row per distinct (day, visitor), streamed like the other groupings
+    return [
+        {"$match": {"page_id": page_id, "event_type": "view", "visitor": {"$nin": [None, ""]}, **_time_range("timestamp", end=before)}},
+        {"$group": {"_id": {"day": _time_bucket_expr("timestamp", 10), "visitor": "$visitor"}}}
+    ]
+
+async def _backfill_rollups(page_id: str):
+    """Builds the rollups of a page from its raw analytics_v2 events, streaming the grouped counters and visitors.
+
+    The total document goes in first, marked as backfilling, with a cutoff
+    time: flushes from then on count the events at or after the cutoff, the
+    backfill the ones before it, and adds them on top when it is done.
+    """
+    total_id = f"{page_id}:{ROLLUP_TOTAL_DAY}"
+    cutoff = datetime.now(timezone.utc)
+    total = await db.analytics_daily.find_one({"id": total_id}, {"_id": 0, "cutoff": 1, "backfilling": 1})
+    if total is not None:
+        if not total.get("backfilling") or cutoff - _parse_time(total["cutoff"]) < timedelta(seconds=BACKFILL_TIMEOUT):
+            # Done, or running in another request
+            return
+        # Leftovers of an interrupted backfill; only the request that removes its total starts over
+        result = await db.analytics_daily.delete_one({"id": total_id, "cutoff": total["cutoff"]})
+        if not result.deleted_count:
+            return
+        await db.analytics_daily.delete_many({"page_id": page_id})
+    try:
+        await db.analytics_daily.insert_one({
+            "id": total_id, "page_id": page_id, "day": ROLLUP_TOTAL_DAY, "views": 0, "clicks": 0,
+            "cutoff": _db_time(cutoff), "backfilling": True
+        })
+    except DuplicateKeyError:
+        # A concurrent request backfills the page
+        return
+    # Events from before the cutoff still queued are not in the rollups: let them reach
+    # analytics_v2 first, ours right away, other workers' within a flush interval
+    await analytics_buffer.flush()
+    await asyncio.sleep(ANALYTICS_FLUSH_INTERVAL)
+
+    total_updates, day_updates = [], {}
+
+    def apply(day: str, update: dict):
+        total_updates.append(update)
+        if day:
+            day_updates.setdefault(day, []).append(update)
+
+    await _aggregate_rollup_groups(page_id, apply, before=cutoff)
+    sketches = {}
+    cursor = db.analytics_v2.aggregate(_visitor_days_pipeline(page_id, cutoff), allowDiskUse=True)
+    async for row in cursor.batch_size(BACKFILL_BATCH_SIZE):
+        day = row["_id"].get("day")
+        for key in (day, ROLLUP_TOTAL_DAY):
+            if key:
+                sketches.setdefault(key, HyperLogLog()).add(row["_id"]["visitor"])
+
+    # Flushes may have created day documents since the cutoff: add to them
+    for day, updates in day_updates.items():
+        update = _merge_rollup_updates(updates)
+        top = _pop_heavy_hitters(update)
+        await db.analytics_daily.update_one(
+            {"id": f"{page_id}:{day}"},
+            {**update, "$setOnInsert": {"page_id": page_id, "day": day}},
+            upsert=True
+        )
+        await _merge_rollup_summaries(f"{page_id}:{day}", [], top, sketches.get(day))
+    update = _merge_rollup_updates(total_updates)
+    top = _pop_heavy_hitters(update)
+    if not update["$inc"]:
+        del update["$inc"]
+    update["$unset"] = {"backfilling": ""}
+    await db.analytics_daily.update_one({"id": total_id}, update)
+    await _merge_rollup_summaries(total_id, [], top, sketches.get(ROLLUP_TOTAL_DAY))
+    page_stats_cache.bump(page_id)
+
+async def _aggregate_rollup_groups(page_id: str, apply, **options):
+    """Streams the groups of _rollup_backfill_pipelines to apply(day, update) as rollup updates."""
+    for name, pipeline in _rollup_backfill_pipelines(page_id, **options).items():
+        cursor = db.analytics_v2.aggregate(pipeline, allowDiskUse=True)
+        async for row in cursor.batch_size(BACKFILL_BATCH_SIZE):
+            day = row["_id"].get("day")
+            if name == "events":
+                field = {"view": "views", "click": "clicks"}.get(row["_id"].get("type"))
+                if field:
+                    apply(day, {"$inc": {field: row["count"]}})
+            elif name == "targets":
+                apply(day, {"$inc": {f"targets.{_rollup_key(row['_id']['target'])}": row["count"]}})
+            elif name == "countries":
+                key = _rollup_key(row["_id"]["country"])
+                apply(day, {"$inc": {f"countries.{key}": row["count"]}, "$set": {f"flags.{key}": row["flag"]}})
+            else:
+                parts = (row["_id"]["source"], row["_id"]["medium"], row["_id"]["campaign"])
+                apply(day, {"$inc": {"utm." + "|".join(_rollup_key(part) for part in parts): row["count"]}})
+
+async def _acquire_lease(name: str, seconds: float) -> bool:
+    """True if this process may run the named periodic job; other workers skip it until the lease runs out."""
+    now = datetime.now(timezone.utc)
+    try:
+        await db.leases.update_one(
+            {"id": name, "until": {"$lt": now.isoformat()}},
+            {"$set": {"until": (now + timedelta(seconds=seconds)).isoformat()}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # The lease document exists and has not run out
+        return False
+    return True
+
+async def _release_lease(name: str):
+    await db.leases.delete_one({"id": name})
+
+# ===== Raw analytics retention =====
+
+# Raw events older than this are compacted into analytics_buckets and deleted; 0 keeps them forever
+ANALYTICS_RETENTION_DAYS = int(os.getenv("ANALYTICS_RETENTION_DAYS", "90"))
+# Size of the buckets old events are compacted into: hour or day
+ANALYTICS_BUCKET = os.getenv("ANALYTICS_BUCKET", "hour")
+ANALYTICS_SWEEP_INTERVAL = float(os.getenv("ANALYTICS_SWEEP_INTERVAL", "3600"))
+
+# Length of the ISO timestamp prefix naming a bucket: "2026-01-31T13" or "2026-01-31"
+ANALYTICS_BUCKET_LENGTHS = {"hour": 13, "day": 10}
+# Compacted events are also kept as columns in per-page monthly files here; empty disables the archive
+ANALYTICS_ARCHIVE_DIR = os.getenv("ANALYTICS_ARCHIVE_DIR", str(ROOT_DIR / "analytics_archive"))
+
+analytics_archive = ColumnArchive(ANALYTICS_ARCHIVE_DIR) if ANALYTICS_ARCHIVE_DIR else None
+STATS_ENGINE_BATCH_SIZE = 10000
+
+async def _load_event_columns(query: dict, columns: EventColumns):
+    """Adds the events matching query to columns, one batch of documents in memory at a time."""
+    cursor = db.analytics_v2.find(query, {"_id": 0, "timestamp": 1, "event_type": 1, "target_id": 1})
+    batch = []
+    async for event in cursor.batch_size(STATS_ENGINE_BATCH_SIZE):
+        batch.append(event)
+        if len(batch) >= STATS_ENGINE_BATCH_SIZE:
+            columns.append(batch)
+            batch = []
+    columns.append(batch)
+
+class AnalyticsRetention:
+    """Compacts raw analytics_v2 events past the retention period into analytics_buckets.
+
+    A bucket document ("<page_id>:<bucket>") holds the same counters as the
+    rollups, for one hour or one day, computed per page with the backfill
+    aggregation. A sweep first claims the expired events of a page by
+    setting their compacted field to a new claim id; the buckets record
+    the claims they were counted from, so a claim left behind by a failed
+    sweep is finished by the next one without counting anything twice. The events themselves go to the column archive, where the
+    stats endpoint still finds them for custom ranges. On MongoDB the compacted events get an expire_at date and
+    the TTL index removes them; the mock DB and SQLite have no TTL monitor,
+    so the sweeper deletes them itself.
+    """
+
+    def __init__(self, retention_days: int, bucket: str, interval: float):
+        if bucket not in ANALYTICS_BUCKET_LENGTHS:
+            raise ValueError(f"Unknown analytics bucket size: {bucket}")
+        self.retention_days = retention_days
+        self.bucket = bucket
+        self.interval = interval
+        self.sweeps = 0
+        self.compacted_pages = 0
+        self.buckets_written = 0
+        self.archived_events = 0
+        self.last_sweep_at = None
+        self.last_sweep_ms = 0.0
+        self._task = None
+
+    def start(self):
+        if self._task is None and self.retention_days > 0 and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            # Only one worker process sweeps per interval
+            if await _acquire_lease("analytics_retention", self.interval * 0.9):
+                try:
+                    await self.sweep()
+                except Exception as e:
+                    logger.error(f"Analytics retention sweep failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def sweep(self):
+        """Compacts and removes every raw event older than the retention period."""
+        started = _time.perf_counter()
+        cutoff = datetime.now(timezone.utc) - timedelta(days=self.retention_days)
+        expired = {**_time_range("timestamp", end=cutoff), "expire_at": {"$exists": False}}
+        pages = await db.analytics_v2.aggregate([{"$match": expired}, {"$group": {"_id": "$page_id"}}]).to_list(None)
+        for page in pages:
+            await self._compact_page(page["_id"], cutoff)
+        self.sweeps += 1
+        self.last_sweep_at = datetime.now(timezone.utc).isoformat()
+        self.last_sweep_ms = (_time.perf_counter() - started) * 1000
+        if pages:
+            logger.info(f"Analytics retention: compacted events of {len(pages)} pages older than {cutoff.isoformat()}")
+
+    async def _compact_page(self, page_id: str, cutoff: datetime):
+        # The rollups are built from raw events, so they must exist before any event goes away
+        total_query = ({"id": f"{page_id}:{ROLLUP_TOTAL_DAY}"}, {"_id": 0, "backfilling": 1})
+        total = await db.analytics_daily.find_one(*total_query)
+        if total is None:
+            await _backfill_rollups(page_id)
+            total = await db.analytics_daily.find_one(*total_query)
+        if total is None or total.get("backfilling"):
+            # Another request is backfilling the page: the next sweep compacts it
+            return
+
+        await db.analytics_v2.update_many(
+            {"page_id": page_id, **_time_range("timestamp", end=cutoff), "expire_at": {"$exists": False}, "compacted": {"$exists": False}},
+            {"$set": {"compacted": uuid.uuid4().hex}}
+        )
+        # This sweep's claim plus any a failed sweep left behind
+        claims = await db.analytics_v2.aggregate([
+            {"$match": {"page_id": page_id, "compacted": {"$exists": True}, "expire_at": {"$exists": False}}},
+            {"$group": {"_id": "$compacted"}}
+        ]).to_list(None)
+        for claim in claims:
+            await self._compact_claim(page_id, claim["_id"])
+        self.compacted_pages += 1
+
+    async def _compact_claim(self, page_id: str, claim: str):
+        buckets: Dict[str, List[dict]] = {}
+        await _aggregate_rollup_groups(
+            page_id, lambda bucket, update: buckets.setdefault(bucket, []).append(update),
+            claim=claim, bucket_length=ANALYTICS_BUCKET_LENGTHS[self.bucket]
+        )
+        for bucket, updates in buckets.items():
+            update = _merge_rollup_updates(updates)
+            update.setdefault("$set", {})[f"claims.{claim}"] = True
+            update["$setOnInsert"] = {"page_id": page_id, "bucket": bucket, "size": self.bucket}
+            try:
+                await db.analytics_buckets.update_one(
+                    {"id": f"{page_id}:{bucket}", f"claims.{claim}": {"$exists": False}}, update, upsert=True
+                )
+            except DuplicateKeyError:
+                # The bucket exists and already counts this claim
+                pass
+        self.buckets_written += len(buckets)
+
+        claimed = {"page_id": page_id, "compacted": claim}
+        if analytics_archive is not None:
+            columns = EventColumns()
+            await _load_event_columns(claimed, columns)
+            columns.finish()
+            await asyncio.to_thread(analytics_archive.append, page_id, columns, claim)
+            self.archived_events += len(columns)
+        if isinstance(client, AsyncIOMotorClient):
+            await db.analytics_v2.update_many(claimed, {"$set": {"expire_at": datetime.now(timezone.utc)}})
+        else:
+            await db.analytics_v2.delete_many(claimed)
+
+    def stats(self) -> dict:
+        return {
+            "retention_days": self.retention_days,
+            "bucket": self.bucket,
+            "interval": self.interval,
+            "sweeps": self.sweeps,
+            "compacted_pages": self.compacted_pages,
+            "buckets_written": self.buckets_written,
+            "archived_events": self.archived_events,
+            "archive_dir": ANALYTICS_ARCHIVE_DIR or None,
+            "last_sweep_at": self.last_sweep_at,
+            "last_sweep_ms": round(self.last_sweep_ms, 2),
+        }
+
+analytics_retention = AnalyticsRetention(ANALYTICS_RETENTION_DAYS, ANALYTICS_BUCKET, ANALYTICS_SWEEP_INTERVAL)
+
+# ===== Timestamp migration =====
+
+# Collection -> time fields converted from ISO strings to the native format
+TIMESTAMP_FIELDS = {
+    "analytics_v2": ["timestamp"],
+    "notifications": ["created_at"],
+    "password_resets": ["expires_at", "created_at"],
+}
+# "auto" converts legacy times in the background after startup; "off" leaves it to the admin endpoint
+TIMESTAMP_MIGRATION = os.getenv("TIMESTAMP_MIGRATION", "auto")
+TIMESTAMP_MIGRATION_BATCH_SIZE = int(os.getenv("TIMESTAMP_MIGRATION_BATCH_SIZE", "1000"))
+# Pause between batches so the migration doesn't crowd out requests
+TIMESTAMP_MIGRATION_PAUSE = float(os.getenv("TIMESTAMP_MIGRATION_PAUSE", "0.1"))
+
+class TimestampMigration:
+    """Online, batched conversion of legacy ISO string times to the native format.
+
+    Each batch reads up to batch_size documents still holding a string and
+    rewrites them with the old string as condition, so a concurrent write
+    is never overwritten. Readers accept both formats, so the app keeps
+    working during the migration and it can stop and resume at any point.
+    """
+
+    def __init__(self, batch_size: int, pause: float):
+        self.batch_size = batch_size
+        self.pause = pause
+        self.converted: Dict[str, int] = {}
+        self.skipped: Dict[str, int] = {}
+        self.running = False
+        self.finished_at = None
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def run(self):
+        # Only one worker process migrates; a second run would only find nothing left to do
+        if not await _acquire_lease("timestamp_migration", 3600):
+            return
+        self.running = True
+        try:
+            for collection, fields in TIMESTAMP_FIELDS.items():
+                for field in fields:
+                    await self._migrate(collection, field)
+            self.finished_at = datetime.now(timezone.utc).isoformat()
+            logger.info(f"Timestamp migration finished: {self.converted}")
+        except Exception as e:
+            logger.error(f"Timestamp migration failed: {e}")
+        finally:
+            self.running = False
+            await _release_lease("timestamp_migration")
+
+    async def _migrate(self, collection: str, field: str):
+        name = f"{collection}.{field}"
+        self.converted.setdefault(name, 0)
+        unparseable = []
+        while True:
+            query = {field: {"$type": "string"}}
+            if unparseable:
+                query["id"] = {"$nin": unparseable}
+            docs = await db[collection].find(query, {"_id": 0, "id": 1, field: 1}).limit(self.batch_size).to_list(self.batch_size)
+            if not docs:
+                return
+            updates = []
+            for doc in docs:
+                try:
+                    updates.append(({"id": doc["id"], field: doc[field]}, {"$set": {field: _db_time(_parse_time(doc[field]))}}))
+                except (KeyError, ValueError):
+                    unparseable.append(doc.get("id"))
+                    self.skipped[name] = self.skipped.get(name, 0) + 1
+            if isinstance(client, AsyncIOMotorClient) and updates:
+                await db[collection].bulk_write([UpdateOne(condition, update) for condition, update in updates], ordered=False)
+            else:
+                for condition, update in updates:
+                    await db[collection].update_one(condition, update)
+            self.converted[name] += len(updates)
+            await asyncio.sleep(self.pause)
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "converted": self.converted,
+            "skipped": self.skipped,
+            "finished_at": self.finished_at,
+        }
+
+timestamp_migration = TimestampMigration(TIMESTAMP_MIGRATION_BATCH_SIZE, TIMESTAMP_MIGRATION_PAUSE)
+
+# ===== Known page ids =====
+
+# "set" keeps the exact ids; "bloom" a Bloom filter for installs with very many pages
+PAGE_ID_FILTER = os.getenv("PAGE_ID_FILTER", "set")
+PAGE_ID_FILTER_ERROR_RATE = float(os.getenv("PAGE_ID_FILTER_ERROR_RATE", "0.01"))
+# Full reload from the DB, a backstop for the version check below
+PAGE_ID_REFRESH_INTERVAL = float(os.getenv("PAGE_ID_REFRESH_INTERVAL", "300"))
+# How often a worker checks whether another one created or deleted a page
+PAGE_ID_VERSION_INTERVAL = float(os.getenv("PAGE_ID_VERSION_INTERVAL", "5"))
+PAGE_ID_VERSION_COUNTER = "page_ids"
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.capacity = capacity
+        self.count = 0
+
+    def _positions(self, item: str):
+        # Double hashing: k positions out of one 128-bit digest
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+class KnownPageIds:
+    """Page ids the track endpoints accept, kept in memory so junk ids never reach the DB.
+
+    In "set" mode the ids are exact and no query is needed. In "bloom" mode
+    ids the filter rules out are rejected for free and the rest are
+    confirmed with one query, since the filter has false positives and
+    cannot forget deleted pages. Until the first load every check goes to
+    the DB.
+
+    Creating or deleting a page bumps a version counter in the DB. Every
+    version_interval seconds each worker reads it and reloads when another
+    worker moved it, so pages created elsewhere are accepted within that
+    interval; the full reload every refresh_interval seconds is a backstop.
+    """
+
+    def __init__(self, mode: str, error_rate: float, refresh_interval: float, version_interval: float):
+        if mode not in ("set", "bloom"):
+            raise ValueError(f"Unknown page id filter: {mode}")
+        self.mode = mode
+        self.error_rate = error_rate
+        self.refresh_interval = refresh_interval
+        self.version_interval = version_interval
+        self.ids = None
+        self.version = None
+        self.loaded_at = 0.0
+        # Changes made while a reload is running, replayed on top of its result
+        self._changes = None
+        # One reload at a time, so none of them drops the changes another is collecting
+        self._lock = asyncio.Lock()
+        self._task = None
+        self._resize = None
+
+    async def _read_version(self) -> int:
+        counter = await db.counters.find_one({"id": PAGE_ID_VERSION_COUNTER}, {"_id": 0, "version": 1})
+        return counter["version"] if counter else 0
+
+    async def _bump_version(self):
+        await db.counters.update_one({"id": PAGE_ID_VERSION_COUNTER}, {"$inc": {"version": 1}}, upsert=True)
+
+    async def load(self):
+        async with self._lock:
+            self._changes = []
+            try:
+                # Read before the pages, so a page created meanwhile triggers another reload
+                version = await self._read_version()
+                pages = await db.pages.find({}, {"_id": 0, "id": 1}).to_list(None)
+                if self.mode == "bloom":
+                    ids = BloomFilter(max(len(pages) * 2, 10000), self.error_rate)
+                else:
+                    ids = set()
+                for page in pages:
+                    ids.add(page["id"])
+                self.ids = ids
+                self.version = version
+                self.loaded_at = _time.monotonic()
+                for added, page_id in self._changes:
+                    if added:
+                        ids.add(page_id)
+                    elif self.mode == "set":
+                        ids.discard(page_id)
+            finally:
+                self._changes = None
+        logger.info(f"Known page ids loaded: {len(pages)} ({self.mode})")
+
+    async def add(self, page_id: str):
+        if self._changes is not None:
+            self._changes.append((True, page_id))
+        if self.ids is not None:
+            self.ids.add(page_id)
+            if self.mode == "bloom" and self.ids.count > self.ids.capacity:
+                # Over capacity the false positive rate climbs: resize on the next reload
+                self.ids.capacity = self.ids.count * 2
+                self._resize = asyncio.create_task(self.load())
+        await self._bump_version()
+
+    async def discard(self, page_id: str):
+        if self._changes is not None:
+            self._changes.append((False, page_id))
+        if self.ids is not None and self.mode == "set":
+            self.ids.discard(page_id)
+        await self._bump_version()
+
+    async def existing(self, page_ids: List[str]) -> set:
+        """The subset of page_ids that belong to existing pages."""
+        if self.ids is None:
+            candidates = list(page_ids)
+        else:
+            candidates = [page_id for page_id in page_ids if page_id in self.ids]
+            if self.mode == "set" or not candidates:
+                return set(candidates)
+        pages = await db.pages.find({"id": {"$in": candidates}}, {"_id": 0, "id": 1}).to_list(len(candidates))
+        return {page["id"] for page in pages}
+
+    def start(self):
+        interval = self.version_interval or self.refresh_interval
+        if self._task is None and interval > 0:
+            self._task = asyncio.create_task(self._refresh_periodically(interval))
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _refresh_periodically(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                expired = self.refresh_interval > 0 and _time.monotonic() - self.loaded_at >= self.refresh_interval
+                if expired or await self._read_version() != self.version:
+                    await self.load()
+            except Exception as e:
+                logger.error(f"Known page ids reload failed: {e}")
+
+known_page_ids = KnownPageIds(PAGE_ID_FILTER, PAGE_ID_FILTER_ERROR_RATE, PAGE_ID_REFRESH_INTERVAL, PAGE_ID_VERSION_INTERVAL)
+
+# ===== Page stats cache =====
+
+STATS_CACHE_SIZE = int(os.getenv("STATS_CACHE_SIZE", "1000"))
+STATS_CACHE_TTL = float(os.getenv("STATS_CACHE_TTL", "60"))
+
+class PageStatsCache:
+    """get_page_stats results by (page id, date range), LRU-bounded.
+
+    An entry is served until it is ttl seconds old or the page's version
+    moves on; the ingestion buffer bumps the version after writing a
+    page's events. Versions are per process, so with several workers the
+    TTL bounds how stale another worker's entry can get.
+
+    Versions come from one counter and are kept for the max_entries most
+    recently used pages. A page without one is at the floor, the highest
+    version dropped so far: forgetting a version can only make an entry
+    stale, never make a stale one current again.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: OrderedDict = OrderedDict()
+        self.versions: OrderedDict = OrderedDict()
+        self.counter = 0
+        self.floor = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+        self.evictions = 0
+
+    def version(self, page_id: str) -> int:
+        return self.versions.get(page_id, self.floor)
+
+    def bump(self, page_id: str):
+        self.counter += 1
+        self._set_version(page_id, self.counter)
+
+    def _set_version(self, page_id: str, version: int):
+        self.versions[page_id] = version
+        self.versions.move_to_end(page_id)
+        while len(self.versions) > self.max_entries:
+            _, dropped = self.versions.popitem(last=False)
+            self.floor = max(self.floor, dropped)
+
+    def get(self, page_id: str, range_key: str):
+        key = (page_id, range_key)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires, version, value = entry
+        if expires < _time.monotonic() or version != self.version(page_id):
+            del self.entries[key]
+            self.invalidated += 1
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self._set_version(page_id, version)
+        self.hits += 1
+        return value
+
+    def put(self, page_id: str, range_key: str, value, version: int):
+        """Stores value computed at version (taken before computing, so a bump meanwhile makes it stale)."""
+        key = (page_id, range_key)
+        self.entries[key] = (_time.monotonic() + self.ttl, version, value)
+        self.entries.move_to_end(key)
+        self._set_version(page_id, self.version(page_id))
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "versions": len(self.versions),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0,
+            "invalidated": self.invalidated,
+            "evictions": self.evictions,
+        }
+
+page_stats_cache = PageStatsCache(STATS_CACHE_SIZE, STATS_CACHE_TTL)
+
+# ===== Analytics ingestion buffer =====
+
+ANALYTICS_QUEUE_SIZE = int(os.getenv("ANALYTICS_QUEUE_SIZE", "10000"))
+ANALYTICS_BATCH_SIZE = int(os.getenv("ANALYTICS_BATCH_SIZE", "500"))
+ANALYTICS_FLUSH_INTERVAL = float(os.getenv("ANALYTICS_FLUSH_INTERVAL", "1.0"))
+# What to do with a full queue: drop_oldest, drop_newest or reject (the track request gets a 503)
+ANALYTICS_BACKPRESSURE = os.getenv("ANALYTICS_BACKPRESSURE", "drop_oldest")
+
+class AnalyticsBuffer:
+    """Accepts analytics events right away and writes them with insert_many from a background task.
+
+    A batch is flushed once batch_size events are queued or every
+    flush_interval seconds. The queue holds at most max_size events; past
+    that the backpressure policy decides which event is dropped.
+
+    A failed insert puts the batch back in the queue; the retry is an
+    unordered insert against the unique id index, so events stored by the
+    failed attempt are skipped as duplicates. Rollup updates of stored
+    events wait in their own list and are retried before the next batch.
+    """
+
+    def __init__(self, max_size: int, batch_size: int, flush_interval: float, policy: str):
+        if policy not in ("drop_oldest", "drop_newest", "reject"):
+            raise ValueError(f"Unknown analytics backpressure policy: {policy}")
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.queue = deque()
+        # (page_id, events, done writes) of stored events not yet in the rollups
+        self.pending_rollups = deque()
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._stopping = False
+        self._task = None
+
+    def add(self, doc: dict) -> bool:
+        """Queues an event. False if the queue is full and the policy is reject."""
+        if len(self.queue) >= self.max_size:
+            self.dropped += 1
+            if self.policy == "reject":
+                return False
+            if self.policy == "drop_newest":
+                return True
+            self.queue.popleft()
+        self.queue.append(doc)
+        self.enqueued += 1
+        if len(self.queue) >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    def add_many(self, docs: List[dict]) -> bool:
+        """Queues a batch as a whole. False if it does not fit and the policy is reject."""
+        if self.policy == "reject" and len(self.queue) + len(docs) > self.max_size:
+            self.dropped += len(docs)
+            return False
+        for doc in docs:
+            self.add(doc)
+        return True
+
+    def start(self):
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stops the background task and drains the queue."""
+        if self._task is not None:
+            # Not cancelled: a cancel landing mid-insert would lose the batch being written
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not await self._apply_rollups():
+                return
+            while self.queue:
+                batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+                started = _time.perf_counter()
+                try:
+                    await self._insert(batch)
+                except Exception as e:
+                    logger.error(f"Analytics flush of {len(batch)} events failed: {e}")
+                    self.failed_flushes += 1
+                    # Back to the front for the next attempt, as far as the queue has room
+                    room = max(self.max_size - len(self.queue), 0)
+                    self.dropped += max(len(batch) - room, 0)
+                    self.queue.extendleft(reversed(batch[:room]))
+                    return
+                self._queue_rollups(batch)
+                applied = await self._apply_rollups()
+                elapsed_ms = (_time.perf_counter() - started) * 1000
+                self.flushes += 1
+                self.written += len(batch)
+                self.last_flush_ms = elapsed_ms
+                self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+                if not applied:
+                    return
+
+    async def _insert(self, batch: List[dict]):
+        try:
+            await db.analytics_v2.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            # Duplicate ids are events an earlier, failed attempt already stored
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])) or e.details.get("writeConcernErrors"):
+                raise
+        except DuplicateKeyError:
+            pass
+
+    async def _apply_rollups(self) -> bool:
+        """Applies the pending rollup updates in order. False if one failed; it stays pending."""
+        while self.pending_rollups:
+            page_id, docs, done = self.pending_rollups[0]
+            try:
+                await _update_rollups(page_id, docs, done)
+            except Exception as e:
+                logger.error(f"Analytics rollup update of page {page_id} failed: {e}")
+                self.failed_flushes += 1
+                return False
+            self.pending_rollups.popleft()
+            page_stats_cache.bump(page_id)
+        return True
+
+    def _queue_rollups(self, batch: List[dict]):
+        pages: Dict[str, List[dict]] = {}
+        for doc in batch:
+            pages.setdefault(doc["page_id"], []).append(doc)
+        for page_id, docs in pages.items():
+            self.pending_rollups.append((page_id, docs, set()))
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": len(self.queue),
+            "pending_rollups": len(self.pending_rollups),
+            "max_size": self.max_size,
+            "policy": self.policy,
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "dropped": self.dropped,
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "max_flush_ms": round(self.max_flush_ms, 2),
+        }
+
+analytics_buffer = AnalyticsBuffer(ANALYTICS_QUEUE_SIZE, ANALYTICS_BATCH_SIZE, ANALYTICS_FLUSH_INTERVAL, ANALYTICS_BACKPRESSURE)
+
+def _analytics_doc(event: AnalyticsEvent, timestamp, visitor: str, geo: Optional[GeoResult]) -> dict:
+    return {
         "id": str(uuid.uuid4()),
         "page_id": event.page_id,
         "event_type": event.event_type,
         "target_id": event.target_id,
-        "metadata": event.metadata,
-        "timestamp": datetime.now(timezone.utc).isoformat()
+        "metadata": _geo_metadata(event.metadata, geo),
+        "visitor": visitor,
+        "timestamp": timestamp
     }
-    await db.analytics_v2.insert_one(doc)
-    return {"status": "ok"}
 
-@api_router.get("/pages/{username}/stats")
-async def get_page_stats(username: str, current_user = Depends(get_current_user)):
-    page = await db.pages.find_one({"username": username})
-    if not page:
+@api_router.post("/analytics/track")
+async def track_event(event: AnalyticsEvent, request: Request):
+    _rate_limit_check(f"track:{request.client.host}", max_requests=TRACK_RATE_LIMIT, window_seconds=60)
+    # Public endpoint, no auth required to record views/clicks
+    # But we check the page id against the known ids to avoid spam
+    if not await known_page_ids.existing([event.page_id]):
         raise HTTPException(status_code=404, detail="Page not found")
-    
-    # Check ownership
-    if page["user_id"] != current_user["id"]:
-         raise HTTPException(status_code=403, detail="Доступ запрещен")
-
-    # Fetch ALL events for this page ONCE (avoid N+1 and extra count queries)
-    all_events = await db.analytics_v2.find({"page_id": page["id"]}).to_list(10000)
-    total_views = sum(1 for e in all_events if e["event_type"] == "view")
-    total_clicks = sum(1 for e in all_events if e["event_type"] == "click")
-
-    # Chart Data (Last 7 days)
-    chart_data = []
-    now = datetime.now(timezone.utc)
-    for i in range(6, -1, -1):
-        day = (now - timedelta(days=i)).strftime("%Y-%m-%d")
-        day_views = 0
-        day_clicks = 0
-        for e in all_events:
-            if e.get("timestamp", "").startswith(day):
-                if e["event_type"] == "view": day_views += 1
-                elif e["event_type"] == "click": day_clicks += 1
-        chart_data.append({
-            "name": day,
-            "views": day_views,
-            "clicks": day_clicks
-        })
-
-    # 4. Top Links
-    click_counts = {}
-    for e in all_events:
-        if e["event_type"] == "click" and e.get("target_id"):
-            tid = e["target_id"]
-            click_counts[tid] = click_counts.get(tid, 0) + 1
+        
+    doc = _analytics_doc(event, _db_time(), _visitor_hash(request), geo_ip.lookup(_client_ip(request)))
+    if not analytics_buffer.add(doc):
+        raise HTTPException(status_code=503, detail="Сервис аналитики перегружен. Попробуйте позже.")
+    return {"status": "ok"}
 
-    top_links = []
-    sorted_clicks = sorted(click_counts.items(), key=lambda x: x[1], reverse=True)[:5]
-    
+@api_router.post("/analytics/track/batch")
+async def track_events_batch(batch: AnalyticsBatch, request: Request):
+    # Same per-IP budget as /analytics/track, counted in events
+    _rate_limit_check(f"track:{request.client.host}", max_requests=TRACK_RATE_LIMIT, window_seconds=60, cost=len(batch.events))
+    # One check for all pages of the batch; events of unknown pages are skipped
+    page_ids = list({e.page_id for e in batch.events})
+    known_pages = await known_page_ids.existing(page_ids) if page_ids else set()
+
+    timestamp = _db_time()
+    visitor = _visitor_hash(request)
+    geo = geo_ip.lookup(_client_ip(request))
+    docs = [_analytics_doc(e, timestamp, visitor, geo) for e in batch.events if e.page_id in known_pages]
+    if not analytics_buffer.add_many(docs):
+        raise HTTPException(status_code=503, detail="Сервис аналитики перегружен. Попробуйте позже.")
+    return {"status": "ok", "accepted": len(docs)}
+
+async def _top_links(sorted_clicks: List[tuple]) -> List[dict]:
     # Batch fetch blocks for top links (avoid N+1)
     top_block_ids = [tid for tid, _ in sorted_clicks]
     top_blocks = {}
     if top_block_ids:
         blocks_list = await db.blocks.find({"id": {"$in": top_block_ids}}).to_list(len(top_block_ids))
         top_blocks = {b["id"]: b for b in blocks_list}
-    
+
+    top_links = []
     for tid, count in sorted_clicks:
         block = top_blocks.get(tid)
         if block:
@@ -1710,21 +3115,136 @@ async def get_page_stats(username: str, current_user = Depends(get_current_user)
                 "title": block["content"].get("title", "Unknown"),
                 "clicks": count
             })
+    return top_links
 
-    # 5. Geography — aggregate countries from view events (reuse all_events)
-    all_views = [e for e in all_events if e["event_type"] == "view"]
-    country_counts = {}
-    for v in all_views:
-        meta = v.get("metadata") or {}
-        country = meta.get("country")
-        if country:
-            flag = meta.get("flag", "")
-            key = country
-            if key not in country_counts:
-                country_counts[key] = {"country": country, "flag": flag, "count": 0}
-            country_counts[key]["count"] += 1
+def _parse_range_day(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Неверный формат даты, ожидается ГГГГ-ММ-ДД")
+
+STATS_MAX_BUCKETS = int(os.getenv("STATS_MAX_BUCKETS", "2000"))
+
+async def _range_stats(page: dict, date_from: Optional[str], date_to: Optional[str], granularity: str) -> dict:
+    """Stats of a custom date range from the raw events, computed with the numpy engine.
 
-    sorted_countries = sorted(country_counts.values(), key=lambda x: x["count"], reverse=True)[:10]
+    from/to are inclusive UTC days; without from the range is the 30 days up
+    to `to` (today by default). Weeks start on Monday. Events compacted by
+    the retention sweep are read from the column archive.
+    """
+    end = (_parse_range_day(date_to) or datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)) + timedelta(days=1)
+    start = _parse_range_day(date_from) or end - timedelta(days=30)
+    if granularity == "week":
+        start -= timedelta(days=start.weekday())
+    step = GRANULARITIES[granularity]
+    if start >= end:
+        raise HTTPException(status_code=400, detail="Начало периода позже конца")
+    if (end - start).total_seconds() / step > STATS_MAX_BUCKETS:
+        raise HTTPException(status_code=400, detail="Слишком большой период для выбранной детализации")
+
+    start_ts, end_ts = int(start.timestamp()), int(end.timestamp())
+    columns = EventColumns()
+    if analytics_archive is not None:
+        await asyncio.to_thread(analytics_archive.load, columns, page["id"], start_ts, end_ts)
+    # Archived events waiting for the TTL monitor are already in the archive
+    query = {"page_id": page["id"], **_time_range("timestamp", start, end), "expire_at": {"$exists": False}}
+    await _load_event_columns(query, columns)
+    columns.finish()
+
+    counts = histogram(columns, start_ts, end_ts, step)
+    label = "%Y-%m-%d %H:00" if granularity == "hour" else "%Y-%m-%d"
+    chart_data = [
+        {
+            "name": (start + timedelta(seconds=i * step)).strftime(label),
+            "views": int(counts["view"][i]),
+            "clicks": int(counts["click"][i])
+        }
+        for i in range(len(counts["view"]))
+    ]
+    total_views = int(counts["view"].sum())
+    total_clicks = int(counts["click"].sum())
+    return {
+        "from": start.strftime("%Y-%m-%d"),
+        "to": (end - timedelta(days=1)).strftime("%Y-%m-%d"),
+        "granularity": granularity,
+        "total_views": total_views,
+        "total_clicks": total_clicks,
+        "ctr": round((total_clicks / total_views * 100), 1) if total_views > 0 else 0,
+        "chart_data": chart_data,
+        "top_links": await _top_links(top_targets(columns, start_ts, end_ts, 5)),
+    }
+
+@api_router.get("/pages/{username}/stats")
+async def get_page_stats(
+    username: str,
+    date_from: Optional[str] = Query(None, alias="from"),
+    date_to: Optional[str] = Query(None, alias="to"),
+    granularity: Optional[Literal["hour", "day", "week"]] = None,
+    current_user = Depends(get_current_user)
+):
+    page = await db.pages.find_one({"username": username})
+    if not page:
+        raise HTTPException(status_code=404, detail="Page not found")
+    
+    # Check ownership
+    if page["user_id"] != current_user["id"]:
+         raise HTTPException(status_code=403, detail="Доступ запрещен")
+
+    # Custom ranges and granularities come from the raw events
+    if date_from or date_to or granularity:
+        return await _range_stats(page, date_from, date_to, granularity or "day")
+
+    # The chart covers the 7 days up to today, so today's date identifies the range
+    now = datetime.now(timezone.utc)
+    month = [(now - timedelta(days=i)).strftime("%Y-%m-%d") for i in range(29, -1, -1)]
+    days = month[-7:]
+    cached = page_stats_cache.get(page["id"], days[-1])
+    if cached is not None:
+        return cached
+    version = page_stats_cache.version(page["id"])
+
+    # At most 31 rollup documents: the all-time one and the last 30 days (for unique visitors)
+    rollup_query = {"page_id": page["id"], "day": {"$in": month + [ROLLUP_TOTAL_DAY]}}
+    rollups = {r["day"]: r for r in await db.analytics_daily.find(rollup_query, {"_id": 0}).to_list(None)}
+    if ROLLUP_TOTAL_DAY not in rollups or rollups[ROLLUP_TOTAL_DAY].get("backfilling"):
+        await _backfill_rollups(page["id"])
+        version = page_stats_cache.version(page["id"])
+        rollups = {r["day"]: r for r in await db.analytics_daily.find(rollup_query, {"_id": 0}).to_list(None)}
+    total = rollups.get(ROLLUP_TOTAL_DAY, {})
+    total_views = total.get("views", 0)
+    total_clicks = total.get("clicks", 0)
+
+    # Chart Data (Last 7 days)
+    chart_data = [
+        {
+            "name": day,
+            "views": rollups.get(day, {}).get("views", 0),
+            "clicks": rollups.get(day, {}).get("clicks", 0),
+            "visitors": _count_visitors([rollups.get(day, {})])
+        }
+        for day in days
+    ]
+
+    # Unique visitors — merged HyperLogLog sketches, approximate
+    unique_visitors = {
+        "today": chart_data[-1]["visitors"],
+        "week": _count_visitors([rollups[day] for day in days if day in rollups]),
+        "month": _count_visitors([rollups[day] for day in month if day in rollups]),
+        "total": _count_visitors([total]),
+    }
+
+    # 4. Top Links
+    top_links = await _top_links([(unquote(key), count) for key, count in _top_counts([total], "top_targets", 5)])
+
+    # 5. Geography — country counters of view events
+    flags = total.get("flags") or {}
+    sorted_countries = sorted(
+        ({"country": unquote(key), "flag": flags.get(key, ""), "count": count}
+         for key, count in (total.get("countries") or {}).items()),
+        key=lambda x: x["count"], reverse=True
+    )[:10]
     views_with_geo = sum(c["count"] for c in sorted_countries)
     geo_data = [
         {
@@ -1736,30 +3256,86 @@ async def get_page_stats(username: str, current_user = Depends(get_current_user)
         for c in sorted_countries
     ]
 
-    # 6. UTM Sources aggregation
-    utm_counts = {}
-    for v in all_views:
-        meta = v.get("metadata") or {}
-        source = meta.get("utm_source")
-        if source:
-            medium = meta.get("utm_medium", "")
-            campaign = meta.get("utm_campaign", "")
-            key = f"{source}|{medium}|{campaign}"
-            if key not in utm_counts:
-                utm_counts[key] = {"utm_source": source, "utm_medium": medium, "utm_campaign": campaign, "count": 0}
-            utm_counts[key]["count"] += 1
+    # 6. UTM Sources — top source|medium|campaign tuples
+    utm_data = []
+    for key, count in _top_counts([total], "top_utm", 20):
+        source, medium, campaign = (unquote(part) for part in key.split("|"))
+        utm_data.append({"utm_source": source, "utm_medium": medium, "utm_campaign": campaign, "count": count})
 
-    utm_data = sorted(utm_counts.values(), key=lambda x: x["count"], reverse=True)[:20]
-
-    return {
+    stats = {
         "total_views": total_views,
         "total_clicks": total_clicks,
         "ctr": round((total_clicks / total_views * 100), 1) if total_views > 0 else 0,
+        "unique_visitors": unique_visitors,
         "chart_data": chart_data,
         "top_links": top_links,
         "geo_data": geo_data,
         "utm_data": utm_data
     }
+    page_stats_cache.put(page["id"], days[-1], stats, version)
+    return stats
+
+EXPORT_BATCH_SIZE = 1000
+EXPORT_CSV_COLUMNS = ["id", "timestamp", "event_type", "target_id", "country", "utm_source", "utm_medium", "utm_campaign"]
+
+def _export_csv_row(event: dict) -> list:
+    meta = event.get("metadata") or {}
+    return [
+        event.get("id"), event.get("timestamp"), event.get("event_type"), event.get("target_id"),
+        meta.get("country"), meta.get("utm_source"), meta.get("utm_medium"), meta.get("utm_campaign"),
+    ]
+
+@api_router.get("/pages/{username}/analytics/export")
+async def export_page_analytics(
+    username: str,
+    format: Literal["ndjson", "csv"] = "ndjson",
+    date_from: Optional[str] = Query(None, alias="from"),
+    date_to: Optional[str] = Query(None, alias="to"),
+    current_user = Depends(get_current_user)
+):
+    """Streams the raw events of a page, oldest first. from/to are inclusive days (YYYY-MM-DD, UTC).
+
+    Events older than the retention period only exist as buckets and are not included.
+    """
+    page = await db.pages.find_one({"username": username})
+    if not page:
+        raise HTTPException(status_code=404, detail="Page not found")
+    if page["user_id"] != current_user["id"]:
+        raise HTTPException(status_code=403, detail="Доступ запрещен")
+    _rate_limit_check(f"export:{current_user['id']}", max_requests=10, window_seconds=300)
+
+    # Compacted events wait for MongoDB's TTL monitor with expire_at set: they are gone already
+    query = {"page_id": page["id"], "expire_at": {"$exists": False}}
+    start, end = _parse_range_day(date_from), _parse_range_day(date_to)
+    if start or end:
+        query.update(_time_range("timestamp", start, end + timedelta(days=1) if end else None))
+    projection = {"_id": 0, "page_id": 0, "visitor": 0, "compacted": 0}
+
+    async def stream():
+        # One batch of events in memory at a time, however many the page has
+        cursor = _find_by_time(db.analytics_v2, query, projection, "timestamp", batch_size=EXPORT_BATCH_SIZE)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if format == "csv":
+            writer.writerow(EXPORT_CSV_COLUMNS)
+        count = 0
+        async for event in cursor:
+            event["timestamp"] = _iso_time(event.get("timestamp"))
+            if format == "csv":
+                writer.writerow(_export_csv_row(event))
+            else:
+                buffer.write(json.dumps(event, ensure_ascii=False, default=str))
+                buffer.write("\n")
+            count += 1
+            if count % EXPORT_BATCH_SIZE == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    media_type = "text/csv; charset=utf-8" if format == "csv" else "application/x-ndjson"
+    filename = f"{username}-analytics.{format}"
+    return StreamingResponse(stream(), media_type=media_type, headers={"Content-Disposition": f'attachment; filename="{filename}"'})
 
 @api_router.post("/pages", response_model=PageResponse)
 async def create_page(page_data: PageCreate, current_user = Depends(get_current_user)):
@@ -1796,6 +3372,7 @@ async def create_page(page_data: PageCreate, current_user = Depends(get_current_
     }
     
     await db.pages.insert_one(page)
+    await known_page_ids.add(page["id"])
     return PageResponse(**page)
 
 @api_router.get("/pages/{username}", response_model=Dict[str, Any])
@@ -1889,6 +3466,7 @@ async def delete_page(page_id: str, current_user = Depends(get_current_user)):
          raise HTTPException(status_code=400, detail="Нельзя удалить основную страницу")
 
     await db.pages.delete_one({"id": page_id})
+    await known_page_ids.discard(page_id)
     await db.blocks.delete_many({"page_id": page_id})
     await db.events.delete_many({"page_id": page_id})
     await db.showcases.delete_many({"page_id": page_id})
@@ -2423,7 +4001,7 @@ async def create_verification_request(
     new_request["user_id"] = current_user["id"]
     new_request["user_email"] = current_user["email"]
     new_request["status"] = "pending"
-    new_request["created_at"] = datetime.now().isoformat()
+    new_request["created_at"] = datetime.now(timezone.utc).isoformat()
 
     await db.verification_requests.insert_one(new_request)
 
@@ -2519,7 +4097,7 @@ async def approve_verification_request(request_id: str, current_admin: dict = De
         "type": "verification",
         "message": message,
         "read": False,
-        "created_at": datetime.now().isoformat()
+        "created_at": _db_time()
     }
     await db.notifications.insert_one(notification)
     
@@ -2558,7 +4136,7 @@ async def reject_verification_request(request_id: str, rejection: RejectionReque
         "type": "verification",
         "message": message,
         "read": False,
-        "created_at": datetime.now().isoformat()
+        "created_at": _db_time()
     }
     await db.notifications.insert_one(notification)
     
@@ -2638,7 +4216,7 @@ async def cancel_verification_request(request_id: str, rejection: RejectionReque
         "type": "verification",
         "message": message,
         "read": False,
-        "created_at": datetime.now().isoformat()
+        "created_at": _db_time()
     }
     await db.notifications.insert_one(notification)
     
@@ -2720,7 +4298,7 @@ async def grant_direct_verification(user_id: str, current_admin: dict = Depends(
             "page_username": page_username,
             "req_type": "personal",
             "status": "approved",
-            "created_at": datetime.now().isoformat()
+            "created_at": datetime.now(timezone.utc).isoformat()
         }
         await db.verification_requests.insert_one(new_request)
 
@@ -2730,7 +4308,7 @@ async def grant_direct_verification(user_id: str, current_admin: dict = Depends(
         "type": "verification",
         "message": "Ваш аккаунт верифицирован администратором.",
         "read": False,
-        "created_at": datetime.now().isoformat()
+        "created_at": _db_time()
     }
     await db.notifications.insert_one(notification)
     
@@ -2770,7 +4348,7 @@ async def send_admin_notification(notification_req: NotificationRequest, current
     if not users_to_notify:
         return {"status": "error", "message": "No users found"}
 
-    timestamp = datetime.now().isoformat()
+    now = datetime.now(timezone.utc)
     campaign_id = str(uuid.uuid4())
     
     # 2. Create Campaign Record
@@ -2779,7 +4357,7 @@ async def send_admin_notification(notification_req: NotificationRequest, current
         "message": notification_req.message,
         "target_type": target_type,
         "recipient_ids": users_to_notify, # Store who was targeted
-        "created_at": timestamp,
+        "created_at": now.isoformat(),
         "total_recipients": len(users_to_notify)
     }
     await db.notification_campaigns.insert_one(campaign)
@@ -2792,7 +4370,7 @@ async def send_admin_notification(notification_req: NotificationRequest, current
         "type": "info",
         "message": notification_req.message,
         "read": False,
-        "created_at": timestamp
+        "created_at": _db_time(now)
     } for uid in users_to_notify]
     
     await db.notifications.insert_many(notifications)
@@ -2802,15 +4380,20 @@ async def send_admin_notification(notification_req: NotificationRequest, current
 async def get_campaigns(current_admin: dict = Depends(get_current_admin)):
     campaigns = await db.notification_campaigns.find({}).sort("created_at", -1).to_list(50)
     
-    # Enrich with read counts dynamically
-    results = []
+    # Enrich with read counts in a single grouped query
+    read_counts = {}
+    if campaigns:
+        cursor = db.notifications.aggregate([
+            {"$match": {"campaign_id": {"$in": [camp["id"] for camp in campaigns]}, "read": True}},
+            {"$group": {"_id": "$campaign_id", "count": {"$sum": 1}}}
+        ])
+        async for row in cursor:
+            read_counts[row["_id"]] = row["count"]
+
     for camp in campaigns:
-        # Count read notifications for this campaign
-        read_count = await db.notifications.count_documents({"campaign_id": camp["id"], "read": True})
-        camp["read_count"] = read_count
-        results.append(camp)
-        
-    return results
+        camp["read_count"] = read_counts.get(camp["id"], 0)
+
+    return campaigns
 
 @api_router.get("/admin/campaigns/{campaign_id}")
 async def get_campaign_details(campaign_id: str, current_admin: dict = Depends(get_current_admin)):
@@ -2846,7 +4429,12 @@ async def get_campaign_details(campaign_id: str, current_admin: dict = Depends(g
 
 @api_router.get("/notifications", response_model=List[NotificationResponse])
 async def get_notifications(current_user: dict = Depends(get_current_user)):
-    notifications = await db.notifications.find({"user_id": current_user["id"]}).sort("created_at", -1).to_list(50)
+    notifications = [
+        notification
+        async for notification in _find_by_time(db.notifications, {"user_id": current_user["id"]}, None, "created_at", -1, limit=50)
+    ]
+    for notification in notifications:
+        notification["created_at"] = _iso_time(notification.get("created_at"))
     return notifications
 
 @api_router.post("/notifications/{notification_id}/read")
@@ -3000,7 +4588,7 @@ async def serve_upload_nested(category: str, subcategory: str, filename: str):
 
 @app.get("/api/health")
 async def health_check():
-    return {"status": "ok", "db": "mock" if USE_MOCK_DB else "mongo"}
+    return {"status": "ok", "db": "sqlite" if USE_SQLITE_DB else "mock" if USE_MOCK_DB else "mongo"}
 
 
 app.include_router(api_router)
@@ -3104,4 +4692,14 @@ app.mount("/api/uploads", StaticFiles(directory=str(UPLOAD_DIR)), name="uploads"
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    known_page_ids.stop()
+    geo_ip.stop()
+    analytics_retention.stop()
+    timestamp_migration.stop()
+    # Write out the queued analytics events while the DB is still open
+    await analytics_buffer.stop()
+    logger.info(f"Analytics buffer drained: {analytics_buffer.stats()}")
+    if isinstance(client, AsyncMockClient):
+        # Write out anything the background flusher has not persisted yet
+        await client.flush()
+    client.close()
@@ -0,0 +1,400 @@
+import asyncio
+import contextlib
+import functools
+import itertools
+import json
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional
+
+from mock_db import (
+    AsyncMockCollection,
+    AsyncMockCursor,
+    DuplicateKeyError,
+    MockUpdateResult,
+    _apply_update,
+    _is_operator_dict,
+    _matches,
+    _upsert_document,
+)
+
+_SQL_RANGE_OPERATORS = {"$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+
+# Rows read per query; a scan is a series of keyset queries on rowid
+ROW_PAGE_SIZE = 500
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+def _field_expr(field: str) -> str:
+    # Index definitions and queries must use the exact same expression for SQLite to match them
+    path = "$" + "".join('."' + part + '"' for part in field.split("."))
+    return f"json_extract(doc, '{path}')"
+
+def _sql_value(value) -> bool:
+    # bool and None compare differently in SQL than in Mongo, leave them to the Python matcher
+    return isinstance(value, (str, int, float)) and not isinstance(value, bool)
+
+def _where(filter_query, indexed_fields):
+    """SQL pre-filter for the conditions on indexed fields that SQLite can answer.
+
+    It only narrows the candidate rows; every row is still checked with the
+    mock DB matcher, so the result has exactly the mock DB semantics.
+    Indexed fields are assumed to hold scalars, not arrays.
+    """
+    clauses, params = [], []
+    for key, cond in filter_query.items():
+        if key == "$and":
+            for part in cond:
+                part_clauses, part_params = _where(part, indexed_fields)
+                clauses.extend(part_clauses)
+                params.extend(part_params)
+            continue
+        if key not in indexed_fields or "'" in key or '"' in key:
+            continue
+        expr = _field_expr(key)
+        if _is_operator_dict(cond):
+            for operator, value in cond.items():
+                if operator == "$in" and value and all(_sql_value(v) for v in value):
+                    clauses.append(f"{expr} IN ({', '.join('?' * len(value))})")
+                    params.extend(value)
+                elif operator in _SQL_RANGE_OPERATORS and _sql_value(value):
+                    clauses.append(f"{expr} {_SQL_RANGE_OPERATORS[operator]} ?")
+                    params.append(value)
+        elif _sql_value(cond):
+            clauses.append(f"{expr} = ?")
+            params.append(cond)
+    return clauses, params
+
+def _dumps(doc) -> str:
+    return json.dumps(doc, ensure_ascii=False, separators=(",", ":"))
+
+@contextlib.contextmanager
+def _transaction(conn):
+    # IMMEDIATE takes the write lock up front, so read-modify-write can't interleave with other writers
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+class MockDeleteResult:
+    def __init__(self, deleted_count):
+        self.deleted_count = deleted_count
+
+class AsyncSQLiteCursor(AsyncMockCursor):
+    """AsyncMockCursor whose matching, sorting and copying run in the client's thread pool.
+
+    Async iteration fetches batch_size documents per trip to the pool, so
+    iterating a large result never holds all of it in memory. Between trips
+    the scan holds no SQLite statement, as _rows reads by rowid pages.
+    """
+
+    def __init__(self, client, docs, project=None):
+        super().__init__(docs, project)
+        self._client = client
+        self._batch_size = 100
+        self._batch = iter(())
+
+    def batch_size(self, count: int):
+        self._batch_size = max(count, 1)
+        return self
+
+    async def to_list(self, length: Optional[int] = None):
+        return await self._client._run(lambda: list(self._iterate(length)))
+
+    async def __anext__(self):
+        if self._iterator is None:
+            # A sort consumes the matches up front, so even building the iterator goes to the pool
+            self._iterator = await self._client._run(self._iterate)
+        try:
+            return next(self._batch)
+        except StopIteration:
+            pass
+        batch = await self._client._run(lambda: list(itertools.islice(self._iterator, self._batch_size)))
+        if not batch:
+            raise StopAsyncIteration
+        self._batch = iter(batch)
+        return next(self._batch)
+
+class AsyncSQLiteCollection(AsyncMockCollection):
+    """One table per collection, one JSON document per row.
+
+    Reuses the mock DB matcher, update operators, projection and
+    aggregation pipeline, so queries behave exactly like on the mock DB;
+    SQLite adds durability and expression indexes. All SQL runs in the
+    client's thread pool.
+    """
+
+    def __init__(self, db, name):
+        super().__init__(db, name)
+        self.client = db.client
+        self.table = f"{db.name}.{name}"
+
+    # ===== Synchronous helpers (worker threads) =====
+
+    def _conn(self):
+        return self.client._connection(self.table)
+
+    def _rows(self, filter_query):
+        # Each page is fetched whole on the calling thread's connection, so a
+        # paused scan keeps no statement open: an open SELECT holds a read
+        # snapshot that makes that connection's next write fail as busy
+        clauses, params = _where(filter_query, self.client._indexed_fields(self.table))
+        sql = f"SELECT rowid, doc FROM {_quote(self.table)} WHERE " + " AND ".join(["rowid > ?", *clauses])
+        sql += " ORDER BY rowid LIMIT ?"
+        last = 0
+        while True:
+            rows = self._conn().execute(sql, [last, *params, ROW_PAGE_SIZE]).fetchall()
+            for rowid, raw in rows:
+                doc = json.loads(raw)
+                if _matches(doc, filter_query):
+                    yield rowid, doc
+            if len(rows) < ROW_PAGE_SIZE:
+                return
+            last = rows[-1][0]
+
+    def _iter_matches(self, filter_query):
+        for _, doc in self._rows(filter_query):
+            yield doc
+
+    def _get_collection_data(self) -> List[Dict[str, Any]]:
+        return list(self._iter_matches({}))
+
+    def _refresh(self):
+        pass
+
+    async def _ensure_loaded(self):
+        pass
+
+    def _insert_rows(self, conn, documents):
+        try:
+            for document in documents:
+                conn.execute(f"INSERT INTO {_quote(self.table)} (doc) VALUES (?)", (_dumps(document),))
+        except sqlite3.IntegrityError as e:
+            raise DuplicateKeyError(str(e))
+
+    def _update_rows(self, conn, rows):
+        try:
+            conn.executemany(f"UPDATE {_quote(self.table)} SET doc = ? WHERE rowid = ?",
+                             [(_dumps(doc), rowid) for rowid, doc in rows])
+        except sqlite3.IntegrityError as e:
+            raise DuplicateKeyError(str(e))
+
+    # ===== Collection API =====
+
+    async def create_index(self, keys, unique=False, **kwargs):
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        name = kwargs.get("name") or "_".join(f"{k}_{d}" for k, d in keys)
+        fields = [field for field, _ in keys]
+
+        def create():
+            conn = self._conn()
+            columns = ", ".join(_field_expr(field) for field in fields)
+            sql = (f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS "
+                   f"{_quote(self.table + ':' + name)} ON {_quote(self.table)} ({columns})")
+            try:
+                conn.execute(sql)
+            except sqlite3.IntegrityError as e:
+                raise DuplicateKeyError(str(e))
+            self.client._add_indexed_fields(self.table, fields)
+
+        await self.client._run(create)
+        return name
+
+    async def find_one(self, filter_query, projection=None):
+        def find_one():
+            for doc in self._iter_matches(filter_query):
+                return self._apply_projection(doc, projection)
+            return None
+        return await self.client._run(find_one)
+
+    def find(self, filter_query=None, projection=None):
+        filter_query = filter_query or {}
+        return AsyncSQLiteCursor(
+            self.client,
+            self._iter_matches(filter_query),
+            lambda doc: self._apply_projection(doc, projection),
+        )
+
+    def aggregate(self, pipeline, **kwargs):
+        pipeline = list(pipeline)
+
+        def run():
+            if pipeline and "$match" in pipeline[0]:
+                docs = self._iter_matches(pipeline[0]["$match"])
+                stages = pipeline[1:]
+            else:
+                docs = self._iter_matches({})
+                stages = pipeline
+            yield from self._run_pipeline(docs, stages)
+
+        return AsyncSQLiteCursor(self.client, run())
+
+    async def count_documents(self, filter_query):
+        def count():
+            if not filter_query:
+                return self._conn().execute(f"SELECT COUNT(*) FROM {_quote(self.table)}").fetchone()[0]
+            return sum(1 for _ in self._rows(filter_query))
+        return await self.client._run(count)
+
+    async def insert_one(self, document):
+        def insert():
+            conn = self._conn()
+            with _transaction(conn):
+                self._insert_rows(conn, [document])
+        await self.client._run(insert)
+        return True
+
+    async def insert_many(self, documents, ordered=True):
+        documents = list(documents)
+
+        def insert_unordered():
+            # A failed INSERT only undoes its own row, the transaction goes on
+            conn = self._conn()
+            duplicate = None
+            with _transaction(conn):
+                for document in documents:
+                    try:
+                        self._insert_rows(conn, [document])
+                    except DuplicateKeyError as e:
+                        duplicate = e
+            if duplicate is not None:
+                raise duplicate
+
+        def insert():
+            # Like an ordered insert: documents before a duplicate stay inserted
+            conn = self._conn()
+            inserted = 0
+            try:
+                with _transaction(conn):
+                    for document in documents:
+                        self._insert_rows(conn, [document])
+                        inserted += 1
+            except DuplicateKeyError:
+                with _transaction(conn):
+                    self._insert_rows(conn, documents[:inserted])
+                raise
+        await self.client._run(insert if ordered else insert_unordered)
+        return True
+
+    async def update_one(self, filter_query, update, upsert=False):
+        def update_one():
+            conn = self._conn()
+            with _transaction(conn):
+                for rowid, doc in self._rows(filter_query):
+                    if not _apply_update(doc, update):
+                        return MockUpdateResult(1, 0)
+                    self._update_rows(conn, [(rowid, doc)])
+                    return MockUpdateResult(1, 1)
+                if upsert:
+                    document = _upsert_document(filter_query, update)
+                    self._insert_rows(conn, [document])
+                    return MockUpdateResult(0, 0, document.get("_id"))
+            return MockUpdateResult(0, 0)
+        return await self.client._run(update_one)
+
+    async def update_many(self, filter_query, update):
+        def update_many():
+            conn = self._conn()
+            with _transaction(conn):
+                rows = list(self._rows(filter_query))
+                for _, doc in rows:
+                    _apply_update(doc, update, track_changes=False)
+                self._update_rows(conn, rows)
+            return MockUpdateResult(len(rows), len(rows))
+        return await self.client._run(update_many)
+
+    async def delete_one(self, filter_query):
+        def delete_one():
+            conn = self._conn()
+            with _transaction(conn):
+                for rowid, _ in self._rows(filter_query):
+                    conn.execute(f"DELETE FROM {_quote(self.table)} WHERE rowid = ?", (rowid,))
+                    return MockDeleteResult(1)
+            return MockDeleteResult(0)
+        return await self.client._run(delete_one)
+
+    async def delete_many(self, filter_query):
+        def delete_many():
+            conn = self._conn()
+            with _transaction(conn):
+                if not filter_query:
+                    return MockDeleteResult(conn.execute(f"DELETE FROM {_quote(self.table)}").rowcount)
+                rowids = [(rowid,) for rowid, _ in self._rows(filter_query)]
+                conn.executemany(f"DELETE FROM {_quote(self.table)} WHERE rowid = ?", rowids)
+            return MockDeleteResult(len(rowids))
+        return await self.client._run(delete_many)
+
+class AsyncSQLiteDatabase:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def __getitem__(self, name):
+        return AsyncSQLiteCollection(self, name)
+
+    def __getattr__(self, name):
+        return self[name]
+
+class AsyncSQLiteClient:
+    """SQLite-backed stand-in for AsyncIOMotorClient.
+
+    Documents are stored as JSON text in one table per collection
+    (`"<db>.<collection>"`), in a WAL-mode database at path. create_index()
+    becomes a SQLite expression index on json_extract() of the fields, and
+    equality, $in and range conditions on indexed fields are pushed down to
+    SQL. Each worker thread of the pool has its own connection; writes run
+    in IMMEDIATE transactions.
+    """
+
+    def __init__(self, path="local_db.sqlite3", max_workers=4, timeout=30.0, synchronous="NORMAL"):
+        self.path = path
+        self.timeout = timeout
+        self.synchronous = synchronous
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sqlite-db")
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections: List[sqlite3.Connection] = []
+        self._tables = set()
+        # table -> fields covered by an index, for the SQL pre-filter
+        self._indexes: Dict[str, set] = {}
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(fn, *args))
+
+    def _connection(self, table=None) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA synchronous={self.synchronous}")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        if table is not None and table not in self._tables:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {_quote(table)} (rowid INTEGER PRIMARY KEY, doc TEXT NOT NULL)")
+            with self._lock:
+                self._tables.add(table)
+        return conn
+
+    def _indexed_fields(self, table) -> set:
+        return self._indexes.get(table, set())
+
+    def _add_indexed_fields(self, table, fields):
+        with self._lock:
+            self._indexes[table] = self._indexes.get(table, set()) | set(fields)
+
+    def __getitem__(self, name):
+        return AsyncSQLiteDatabase(self, name)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
@@ -5,7 +5,7 @@ import { toast } from '../utils/toast';
 import {
     BarChart, Bar, XAxis, YAxis, CartesianGrid, Tooltip, ResponsiveContainer, AreaChart, Area
 } from 'recharts';
-import { ArrowLeft, Users, MousePointer2, Percent, TrendingUp, ExternalLink, Globe } from 'lucide-react';
+import { ArrowLeft, Users, UserCheck, MousePointer2, Percent, TrendingUp, ExternalLink, Globe } from 'lucide-react';
 
 const Analytics = () => {
     const { username } = useParams();
@@ -63,13 +63,19 @@ const Analytics = () => {
                 </div>
 
                 {/* Stats Grid */}
-                <div className="grid grid-cols-1 md:grid-cols-3 gap-6">
+                <div className="grid grid-cols-1 md:grid-cols-2 lg:grid-cols-4 gap-6">
                     <StatCard
                         title="Просмотры"
                         value={stats.total_views}
                         icon={<Users className="w-5 h-5 text-blue-400" />}
                         description="Всего заходов на страницу"
                     />
+                    <StatCard
+                        title="Уникальные посетители"
+                        value={stats.unique_visitors?.week ?? 0}
+                        icon={<UserCheck className="w-5 h-5 text-orange-400" />}
+                        description={`За 7 дней · за 30 дней: ${stats.unique_visitors?.month ?? 0}`}
+                    />
                     <StatCard
                         title="Клики"
                         value={stats.total_clicks}
@@ -96,6 +96,40 @@ const fetchWithAuth = async (url, options = {}) => {
   return response;
 };
 
+// Analytics events are queued and sent together to /analytics/track/batch
+const TRACK_BATCH_DELAY = 1000;
+const TRACK_BATCH_MAX = 50;
+let trackQueue = [];
+let trackWaiters = [];
+let trackTimer = null;
+
+const flushTrackQueue = () => {
+  clearTimeout(trackTimer);
+  trackTimer = null;
+  const waiters = trackWaiters;
+  trackWaiters = [];
+  const sends = [];
+  while (trackQueue.length) {
+    const events = trackQueue.splice(0, TRACK_BATCH_MAX);
+    sends.push(fetchWithRetry(`${API_URL}/analytics/track/batch`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ events }),
+      keepalive: true, // survives the page being closed
+    }));
+  }
+  return Promise.all(sends).then(
+    () => waiters.forEach(({ resolve }) => resolve({ ok: true })),
+    (error) => waiters.forEach(({ reject }) => reject(error)),
+  );
+};
+
+if (typeof document !== 'undefined') {
+  document.addEventListener('visibilitychange', () => {
+    if (document.visibilityState === 'hidden') flushTrackQueue();
+  });
+}
+
 export const api = {
   // Auth
   register: (data) => fetchWithRetry(`${API_URL}/auth/register`, {
@@ -162,10 +196,14 @@ export const api = {
   // Analytics
   trackEvent: (data) => {
     if (!data.username) return Promise.resolve({ ok: true }); // Prevent 422
-    return fetchWithRetry(`${API_URL}/analytics/track`, {
-      method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify(data),
+    return new Promise((resolve, reject) => {
+      trackQueue.push(data);
+      trackWaiters.push({ resolve, reject });
+      if (trackQueue.length >= TRACK_BATCH_MAX) {
+        flushTrackQueue();
+      } else if (!trackTimer) {
+        trackTimer = setTimeout(flushTrackQueue, TRACK_BATCH_DELAY);
+      }
     });
   },
   getPageAnalytics: (username) => fetchWithAuth(`${API_URL}/pages/${username}/stats`),